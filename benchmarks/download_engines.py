@@ -0,0 +1,140 @@
+"""Compares the download engines on a queue of many small files, similar to
+the asset objects of a modern version, served by a local HTTP server.
+
+    python benchmarks/download_engines.py --files 4000 --size 4096
+"""
+
+import argparse
+import functools
+import hashlib
+import http.server
+import multiprocessing
+import os
+import sys
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import picomc.logging  # noqa: E402
+from picomc.downloader import (  # noqa: E402
+    DownloadQueue,
+    DownloadSettings,
+    parse_workers,
+)
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # The handler writes the headers and the body separately, which would
+    # otherwise stall every response on delayed ACKs.
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(directory, port_queue):
+    handler = functools.partial(QuietHandler, directory=directory)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+
+def start_server(directory):
+    # The server runs in its own process so that it does not compete with the
+    # engine being measured for the GIL.
+    port_queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(
+        target=serve, args=(directory, port_queue), daemon=True
+    )
+    proc.start()
+    return proc, port_queue.get()
+
+
+def make_files(directory, count, size):
+    files = []
+    for n in range(count):
+        data = os.urandom(size)
+        sha1 = hashlib.sha1(data).hexdigest()
+        path = Path(directory, sha1[0:2], sha1)
+        path.parent.mkdir(exist_ok=True)
+        path.write_bytes(data)
+        files.append((sha1, size))
+    return files
+
+
+def run(engine, base_url, files, dest_root, connections, workers):
+    q = DownloadQueue()
+    q.settings = DownloadSettings(
+        engine=engine, host_connections=connections, workers=workers
+    )
+    for sha1, size in files:
+        path = "{}/{}".format(sha1[0:2], sha1)
+        q.add(base_url + path, Path(dest_root, path), size=size, sha1=sha1)
+    start = time.perf_counter()
+    ok = q.download()
+    elapsed = time.perf_counter() - start
+    if not ok:
+        raise RuntimeError("{} engine failed to download some files".format(engine))
+    return elapsed, q
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=4000)
+    parser.add_argument("--size", type=int, default=4096)
+    parser.add_argument(
+        "--large", type=int, default=0, help="Large files queued after the rest."
+    )
+    parser.add_argument("--large-size", type=int, default=32 * 1024 * 1024)
+    parser.add_argument("--connections", type=int, default=16)
+    parser.add_argument("--workers", type=parse_workers, default="auto")
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    # Disables the progress bars
+    picomc.logging.debug = True
+
+    with TemporaryDirectory() as srcdir, TemporaryDirectory() as outdir:
+        files = make_files(srcdir, args.files, args.size)
+        files += make_files(srcdir, args.large, args.large_size)
+        server, port = start_server(srcdir)
+        base_url = "http://127.0.0.1:{}/".format(port)
+        print(
+            "{} files of {} bytes, {} of {} bytes, {} connections, {} workers".format(
+                args.files,
+                args.size,
+                args.large,
+                args.large_size,
+                args.connections,
+                args.workers or "auto",
+            )
+        )
+        for engine in ("thread", "asyncio"):
+            times = []
+            efficiency = []
+            for n in range(args.runs):
+                dest_root = Path(outdir, "{}-{}".format(engine, n))
+                elapsed, q = run(
+                    engine, base_url, files, dest_root, args.connections, args.workers
+                )
+                times.append(elapsed)
+                efficiency.append(q.ideal_makespan / q.makespan)
+            print(
+                "{:8} best {:.2f}s, mean {:.2f}s, {} workers at the end, "
+                "makespan efficiency {:.0%} (ideal / achieved)".format(
+                    engine,
+                    min(times),
+                    sum(times) / len(times),
+                    q.workers,
+                    sum(efficiency) / len(efficiency),
+                )
+            )
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Compares ways of verifying the hashes of many files, similar to the asset
+objects and libraries checked by --verify: serially, with the thread pool of
+picomc.verify and with a process pool.
+
+    python benchmarks/verify.py --files 4000 --size 65536
+
+The files are freshly written, so this measures hashing from the page cache.
+Drop the caches between runs (as root, `echo 3 > /proc/sys/vm/drop_caches`)
+and use --runs 1 to include the disk.
+"""
+
+import argparse
+import hashlib
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import picomc.logging  # noqa: E402
+from picomc.hashcache import HashCache  # noqa: E402
+from picomc.utils import file_sha1  # noqa: E402
+from picomc.verify import get_default_workers, verify_files  # noqa: E402
+
+
+def make_files(directory, count, size):
+    files = []
+    for n in range(count):
+        data = os.urandom(size)
+        sha1 = hashlib.sha1(data).hexdigest()
+        path = Path(directory, sha1[0:2], sha1)
+        path.parent.mkdir(exist_ok=True)
+        path.write_bytes(data)
+        files.append((path, sha1))
+    return files
+
+
+def run_serial(files, cache_path, workers):
+    return [file_sha1(path) == sha1 for path, sha1 in files]
+
+
+def run_threads(files, cache_path, workers):
+    # A fresh cache, so that every file actually gets hashed
+    cache = HashCache(cache_path)
+    return [ok for _, ok in verify_files(cache, files, workers=workers)]
+
+
+def check(entry):
+    path, sha1 = entry
+    return file_sha1(path) == sha1
+
+
+def run_processes(files, cache_path, workers):
+    with ProcessPoolExecutor(max_workers=workers) as ppe:
+        return list(ppe.map(check, files, chunksize=64))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=4000)
+    parser.add_argument("--size", type=int, default=64 * 1024)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    # Disables the progress bars
+    picomc.logging.debug = True
+
+    default = get_default_workers()
+    variants = [("serial", run_serial, 1)]
+    variants += [
+        ("threads", run_threads, n) for n in sorted({2, 4, default, default * 2})
+    ]
+    variants += [("processes", run_processes, os.cpu_count() or 1)]
+
+    with TemporaryDirectory() as srcdir:
+        files = make_files(srcdir, args.files, args.size)
+        print(
+            "{} files of {} bytes, {} cpus".format(
+                args.files, args.size, os.cpu_count()
+            )
+        )
+        for name, fn, workers in variants:
+            times = []
+            for n in range(args.runs):
+                start = time.perf_counter()
+                results = fn(files, Path(srcdir, "hashes.json"), workers)
+                times.append(time.perf_counter() - start)
+                if not all(results) or len(results) != len(files):
+                    raise RuntimeError("{} failed to verify the files".format(name))
+            print(
+                "{:9} {:3} workers: best {:.2f}s, mean {:.2f}s".format(
+                    name, workers, min(times), sum(times) / len(times)
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
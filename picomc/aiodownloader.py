@@ -0,0 +1,640 @@
+import asyncio
+import ssl
+import time
+import urllib.parse
+from collections import defaultdict
+
+import certifi
+
+try:
+    from urllib3 import HTTPHeaderDict
+except ImportError:  # urllib3 < 2
+    from urllib3.response import HTTPHeaderDict
+
+import picomc
+from picomc.downloader import (
+    BaseDownloader,
+    DownloadError,
+    DownloadFailure,
+    ItemProgress,
+)
+from picomc.logging import logger
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.errors
+    import h2.events
+    import h2.exceptions
+    import h2.settings
+except ImportError:
+    h2 = None
+
+REDIRECT_STATUSES = frozenset([301, 302, 303, 307, 308])
+MAX_REDIRECTS = 5
+CHUNK_SIZE = 64 * 1024
+# Flow control windows of HTTP/2 connections and streams
+H2_CONNECTION_WINDOW = 16 * 1024 * 1024
+H2_STREAM_WINDOW = 1024 * 1024
+
+
+class AsyncConnection:
+    def __init__(self, key, reader, writer):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.reused = False
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncResponse:
+    """A response whose body is read incrementally. The connection and the
+    host slot are held until release_conn is called."""
+
+    def __init__(self, client, conn, status, headers):
+        self.client = client
+        self.conn = conn
+        self.status = status
+        self.headers = headers
+        self.done = False
+        self.released = False
+
+        te = headers.get("Transfer-Encoding", "").lower()
+        self.chunked = te == "chunked"
+        self.chunk_left = 0
+        self.length = None
+        self.keep_alive = headers.get("Connection", "").lower() != "close"
+        if status in (204, 304):
+            self.done = True
+        elif not self.chunked:
+            if "Content-Length" in headers:
+                self.length = int(headers["Content-Length"])
+                self.done = self.length == 0
+            else:
+                # The body ends when the connection is closed.
+                self.keep_alive = False
+
+    async def _read(self, coro):
+        try:
+            return await asyncio.wait_for(coro, self.client.timeout)
+        except asyncio.IncompleteReadError:
+            raise ConnectionError("Connection closed prematurely") from None
+
+    async def read(self, amt=CHUNK_SIZE):
+        if self.done:
+            return b""
+        reader = self.conn.reader
+        if self.chunked:
+            if self.chunk_left == 0:
+                line = await self._read(reader.readline())
+                try:
+                    self.chunk_left = int(line.split(b";")[0], 16)
+                except ValueError:
+                    raise DownloadError("Malformed chunked encoding") from None
+                if self.chunk_left == 0:
+                    # Skip the trailer
+                    while await self._read(reader.readline()) not in (b"\r\n", b""):
+                        pass
+                    self.done = True
+                    return b""
+            data = await self._read(reader.read(min(amt, self.chunk_left)))
+            if not data:
+                raise ConnectionError("Connection closed prematurely")
+            self.chunk_left -= len(data)
+            if self.chunk_left == 0:
+                await self._read(reader.readexactly(2))
+            return data
+        elif self.length is not None:
+            data = await self._read(reader.read(min(amt, self.length)))
+            if not data:
+                raise ConnectionError("Connection closed prematurely")
+            self.length -= len(data)
+            self.done = self.length == 0
+            return data
+        else:
+            data = await self._read(reader.read(amt))
+            self.done = not data
+            return data
+
+    async def drain(self):
+        while await self.read():
+            pass
+
+    def release_conn(self):
+        if self.released:
+            return
+        self.released = True
+        if self.done and self.keep_alive:
+            self.client.put_connection(self.conn)
+        else:
+            self.conn.close()
+        self.client.get_host_limit(self.conn.key[1]).release()
+
+
+class H2Stream:
+    def __init__(self, conn, stream_id):
+        self.conn = conn
+        self.stream_id = stream_id
+        self.head = asyncio.get_running_loop().create_future()
+        # Received data chunks, None at the end of the stream or an exception
+        self.chunks = asyncio.Queue()
+
+    def on_headers(self, headers):
+        status = None
+        resp_headers = HTTPHeaderDict()
+        for name, value in headers:
+            if name == ":status":
+                status = int(value)
+            else:
+                resp_headers.add(name, value)
+        if not self.head.done():
+            self.head.set_result((status, resp_headers))
+
+    def on_error(self, ex):
+        if not self.head.done():
+            self.head.set_exception(ex)
+        self.chunks.put_nowait(ex)
+
+
+class AsyncH2Connection:
+    """A HTTP/2 connection, over which any number of requests to the same
+    host are multiplexed as streams. A background task reads the frames and
+    dispatches them to the streams."""
+
+    def __init__(self, key, reader, writer, timeout):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.streams = dict()
+        self.closed = False
+        self.stream_closed = asyncio.Event()
+        config = h2.config.H2Configuration(client_side=True, header_encoding="latin-1")
+        self.h2 = h2.connection.H2Connection(config=config)
+        self.h2.initiate_connection()
+        self.h2.update_settings(
+            {h2.settings.SettingCodes.INITIAL_WINDOW_SIZE: H2_STREAM_WINDOW}
+        )
+        self.h2.increment_flow_control_window(
+            H2_CONNECTION_WINDOW - self.h2.inbound_flow_control_window
+        )
+        self.flush()
+        self.reader_task = asyncio.ensure_future(self.read_frames())
+
+    def flush(self):
+        data = self.h2.data_to_send()
+        if data:
+            self.writer.write(data)
+
+    def is_usable(self):
+        return not self.closed
+
+    async def request(self, headers):
+        while (
+            self.h2.open_outbound_streams
+            >= self.h2.remote_settings.max_concurrent_streams
+        ):
+            self.stream_closed.clear()
+            await asyncio.wait_for(self.stream_closed.wait(), self.timeout)
+        if self.closed:
+            raise ConnectionError("Connection closed by server")
+        stream_id = self.h2.get_next_available_stream_id()
+        stream = H2Stream(self, stream_id)
+        self.streams[stream_id] = stream
+        try:
+            self.h2.send_headers(stream_id, headers, end_stream=True)
+            self.flush()
+            await asyncio.wait_for(self.writer.drain(), self.timeout)
+            status, resp_headers = await asyncio.wait_for(stream.head, self.timeout)
+        except h2.exceptions.ProtocolError as ex:
+            self.end_stream(stream)
+            raise ConnectionError(str(ex)) from ex
+        except BaseException:
+            self.end_stream(stream)
+            raise
+        return stream, status, resp_headers
+
+    async def read_frames(self):
+        try:
+            while True:
+                data = await self.reader.read(CHUNK_SIZE)
+                if not data:
+                    raise ConnectionError("Connection closed by server")
+                for event in self.h2.receive_data(data):
+                    self.handle_event(event)
+                self.flush()
+        except (OSError, h2.exceptions.ProtocolError) as ex:
+            self.fail(ex)
+
+    def handle_event(self, event):
+        if isinstance(event, h2.events.ConnectionTerminated):
+            # Streams up to last_stream_id are still processed by the server.
+            last_stream_id = event.last_stream_id or 0
+            self.closed = True
+            for stream_id, stream in list(self.streams.items()):
+                if stream_id > last_stream_id:
+                    stream.on_error(ConnectionError("Connection closed by server"))
+            return
+        stream = self.streams.get(getattr(event, "stream_id", None))
+        if stream is None:
+            if isinstance(event, h2.events.DataReceived):
+                self.h2.acknowledge_received_data(
+                    event.flow_controlled_length, event.stream_id
+                )
+            return
+        if isinstance(event, h2.events.ResponseReceived):
+            stream.on_headers(event.headers)
+        elif isinstance(event, h2.events.DataReceived):
+            stream.chunks.put_nowait((event.data, event.flow_controlled_length))
+        elif isinstance(event, h2.events.StreamEnded):
+            stream.chunks.put_nowait(None)
+        elif isinstance(event, h2.events.StreamReset):
+            stream.on_error(ConnectionError("Stream reset by server"))
+
+    def fail(self, ex):
+        self.closed = True
+        for stream in self.streams.values():
+            stream.on_error(ex)
+        self.writer.close()
+
+    def acknowledge(self, stream, length):
+        if self.closed:
+            return
+        self.h2.acknowledge_received_data(length, stream.stream_id)
+        self.flush()
+
+    def end_stream(self, stream, complete=False):
+        """Forgets a stream. An unfinished stream is reset and the data
+        buffered for it is released to the connection window."""
+        if self.streams.pop(stream.stream_id, None) is None:
+            return
+        if not complete and not self.closed:
+            try:
+                self.h2.reset_stream(stream.stream_id, h2.errors.ErrorCodes.CANCEL)
+            except h2.exceptions.StreamClosedError:
+                pass
+            while not stream.chunks.empty():
+                chunk = stream.chunks.get_nowait()
+                if isinstance(chunk, tuple):
+                    self.h2.acknowledge_received_data(chunk[1], stream.stream_id)
+            self.flush()
+        self.stream_closed.set()
+
+    def close(self):
+        self.closed = True
+        self.reader_task.cancel()
+        self.writer.close()
+
+
+class AsyncH2Response:
+    """A response received on a HTTP/2 stream, with the same interface as
+    AsyncResponse."""
+
+    def __init__(self, client, conn, stream, status, headers):
+        self.client = client
+        self.conn = conn
+        self.stream = stream
+        self.status = status
+        self.headers = headers
+        self.done = False
+        self.released = False
+
+    async def read(self, amt=CHUNK_SIZE):
+        if self.done:
+            return b""
+        chunk = await asyncio.wait_for(self.stream.chunks.get(), self.client.timeout)
+        if chunk is None:
+            self.done = True
+            return b""
+        if isinstance(chunk, Exception):
+            raise chunk
+        data, length = chunk
+        # Only consumed data opens the window, so that the server cannot send
+        # faster than the data is written out.
+        self.conn.acknowledge(self.stream, length)
+        return data
+
+    async def drain(self):
+        while await self.read():
+            pass
+
+    def release_conn(self):
+        if self.released:
+            return
+        self.released = True
+        self.conn.end_stream(self.stream, complete=self.done)
+        self.client.get_host_limit(self.conn.key[1]).release()
+
+
+class AsyncHTTPClient:
+    """A minimal HTTP client on top of asyncio streams. It keeps idle
+    connections alive for reuse and limits the number of concurrent requests
+    to each host. If h2 is installed, HTTP/2 is negotiated with TLS servers
+    which support it, and all requests to such a server share a single
+    connection."""
+
+    def __init__(self, timeout, host_connections, http2=True):
+        self.timeout = timeout
+        self.host_connections = host_connections
+        self.http2 = http2 and h2 is not None
+        self.ssl_context = ssl.create_default_context(cafile=certifi.where())
+        if self.http2:
+            self.ssl_context.set_alpn_protocols(["h2", "http/1.1"])
+        self.idle = defaultdict(list)
+        self.h2_conns = dict()
+        # Hosts whose first connection is being established. Until it is
+        # known whether they speak HTTP/2, other requests wait for it.
+        self.probing = dict()
+        self.probed = set()
+        self.host_limits = dict()
+        self.user_agent = "picomc/{}".format(picomc.__version__)
+
+    def get_host_limit(self, host):
+        if host not in self.host_limits:
+            self.host_limits[host] = asyncio.Semaphore(self.host_connections)
+        return self.host_limits[host]
+
+    async def get_connection(self, key):
+        while True:
+            h2_conn = self.h2_conns.get(key)
+            if h2_conn is not None:
+                if h2_conn.is_usable():
+                    return h2_conn
+                del self.h2_conns[key]
+            idle = self.idle[key]
+            while idle:
+                conn = idle.pop()
+                if not conn.reader.at_eof():
+                    conn.reused = True
+                    return conn
+                conn.close()
+            if key not in self.probing:
+                break
+            await self.probing[key].wait()
+
+        probe = self.http2 and key[0] == "https" and key not in self.probed
+        if probe:
+            self.probing[key] = asyncio.Event()
+        try:
+            return await self.connect(key)
+        finally:
+            if probe:
+                self.probed.add(key)
+                self.probing.pop(key).set()
+
+    async def connect(self, key):
+        scheme, host, port = key
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(
+                host,
+                port,
+                ssl=self.ssl_context if scheme == "https" else None,
+                server_hostname=host if scheme == "https" else None,
+            ),
+            self.timeout,
+        )
+        ssl_object = writer.get_extra_info("ssl_object")
+        if ssl_object is not None and ssl_object.selected_alpn_protocol() == "h2":
+            conn = AsyncH2Connection(key, reader, writer, self.timeout)
+            self.h2_conns[key] = conn
+            return conn
+        return AsyncConnection(key, reader, writer)
+
+    def put_connection(self, conn):
+        self.idle[conn.key].append(conn)
+
+    async def request(self, url, headers=None):
+        for _ in range(MAX_REDIRECTS + 1):
+            resp = await self.request_once(url, headers or {})
+            if resp.status in REDIRECT_STATUSES and "Location" in resp.headers:
+                try:
+                    await resp.drain()
+                finally:
+                    resp.release_conn()
+                url = urllib.parse.urljoin(url, resp.headers["Location"])
+                continue
+            return resp
+        raise DownloadError("Too many redirects", retryable=False)
+
+    async def request_once(self, url, headers):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            raise DownloadError(
+                "Unsupported scheme {}".format(parts.scheme), retryable=False
+            )
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        key = (parts.scheme, parts.hostname, port)
+        target = parts.path or "/"
+        if parts.query:
+            target += "?" + parts.query
+
+        limit = self.get_host_limit(parts.hostname)
+        await limit.acquire()
+        try:
+            conn = await self.get_connection(key)
+            if isinstance(conn, AsyncH2Connection):
+                h2_headers = [
+                    (":method", "GET"),
+                    (":scheme", parts.scheme),
+                    (":authority", parts.netloc),
+                    (":path", target),
+                    ("user-agent", self.user_agent),
+                ]
+                h2_headers += [(k.lower(), v) for k, v in headers.items()]
+                stream, status, resp_headers = await conn.request(h2_headers)
+                return AsyncH2Response(self, conn, stream, status, resp_headers)
+
+            lines = [
+                "GET {} HTTP/1.1".format(target),
+                "Host: {}".format(parts.netloc),
+                "User-Agent: {}".format(self.user_agent),
+                "Accept-Encoding: identity",
+            ]
+            lines += ["{}: {}".format(k, v) for k, v in headers.items()]
+            head = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+            try:
+                status, resp_headers = await self.send(conn, head)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                conn.close()
+                if not conn.reused:
+                    raise
+                # The server has closed the idle connection in the meantime.
+                conn = await self.get_connection(key)
+                status, resp_headers = await self.send(conn, head)
+        except BaseException:
+            limit.release()
+            raise
+        return AsyncResponse(self, conn, status, resp_headers)
+
+    async def send(self, conn, head):
+        try:
+            conn.writer.write(head)
+            await asyncio.wait_for(conn.writer.drain(), self.timeout)
+            while True:
+                status, headers = await self.read_head(conn.reader)
+                # Skip informational responses
+                if not 100 <= status < 200:
+                    return status, headers
+        except BaseException:
+            conn.close()
+            raise
+
+    async def read_head(self, reader):
+        async def readline():
+            line = await asyncio.wait_for(reader.readline(), self.timeout)
+            if not line:
+                raise ConnectionError("Connection closed by server")
+            return line
+
+        status_line = (await readline()).decode("latin-1").split(None, 2)
+        try:
+            status = int(status_line[1])
+        except (IndexError, ValueError):
+            raise DownloadError("Malformed status line") from None
+        headers = HTTPHeaderDict()
+        while True:
+            line = (await readline()).decode("latin-1")
+            if line in ("\r\n", "\n"):
+                return status, headers
+            name, sep, value = line.partition(":")
+            if not sep:
+                raise DownloadError("Malformed header")
+            headers.add(name.strip(), value.strip())
+
+    def close(self):
+        for conns in self.idle.values():
+            for conn in conns:
+                conn.close()
+        self.idle.clear()
+        for conn in self.h2_conns.values():
+            conn.close()
+        self.h2_conns.clear()
+
+
+class AsyncDownloader(BaseDownloader):
+    """A download engine running all transfers in a single asyncio event loop.
+    Unlike the thread engine, an in-flight download costs a coroutine rather
+    than a thread, which pays off for queues of thousands of small files."""
+
+    async def download_file(self, client, i, item, sz_callback):
+        progress = ItemProgress(sz_callback)
+        attempt = 0
+        while True:
+            if self.stop_event.is_set():
+                raise InterruptedError
+            try:
+                await self.fetch(client, i, item, progress)
+                return
+            except InterruptedError:
+                raise
+            except (DownloadError, OSError, asyncio.TimeoutError) as ex:
+                delay = self.get_retry_delay(item, ex, attempt)
+                if delay is None:
+                    return
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    async def fetch(self, client, i, item, progress):
+        partial, offset, headers = self.start_attempt(i, item)
+        start = time.monotonic()
+        resp = await client.request(item.url, headers)
+        self.on_response(item, time.monotonic() - start)
+        try:
+            accepted = self.accept_response(item, partial, offset, resp)
+            if accepted is None:
+                await resp.drain()
+                resp.release_conn()
+                return await self.fetch(client, i, item, progress)
+            offset, mode, digest = accepted
+            progress.seek(offset)
+            partial.begin(offset)
+            with open(partial.path, mode) as fd:
+                try:
+                    while True:
+                        if self.stop_event.is_set():
+                            raise InterruptedError
+                        buf = await resp.read()
+                        if not buf:
+                            break
+                        fd.write(buf)
+                        digest.update(buf)
+                        progress.advance(len(buf))
+                        delay = self.throttle(len(buf))
+                        if delay:
+                            await asyncio.sleep(delay)
+                except BaseException:
+                    partial.save_meta(fd.tell())
+                    raise
+                written = fd.tell()
+        finally:
+            resp.release_conn()
+        self.finish(item, partial, written, digest)
+
+    async def download_all(self, tq):
+        client = AsyncHTTPClient(
+            self.settings.timeout,
+            self.settings.host_connections,
+            http2=self.settings.http2,
+        )
+
+        cb = self.make_callback(tq)
+
+        async def run(i, item):
+            try:
+                await self.download_file(client, i, item, cb)
+            except Exception as ex:
+                self.failures.append(
+                    DownloadFailure(
+                        item.url, item.dest, str(ex), priority=item.priority
+                    )
+                )
+            else:
+                if not self.known_size:
+                    tq.update(1)
+
+        running = dict()
+        started = dict()
+        try:
+            while True:
+                for i, item in self.scheduler.take(self.workers):
+                    task = asyncio.ensure_future(run(i, item))
+                    running[task] = item
+                    started[task] = time.monotonic()
+                if not running:
+                    break
+                # Failures are recorded by run itself.
+                done, _ = await asyncio.wait(
+                    running,
+                    timeout=self.poll_interval,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for task in done:
+                    self.item_done(
+                        running.pop(task), time.monotonic() - started.pop(task)
+                    )
+                self.update_workers(saturated=self.scheduler.is_saturated(self.workers))
+        finally:
+            for task in running:
+                task.cancel()
+            client.close()
+
+    def download(self):
+        logger.debug("Downloading {} files.".format(self.total))
+
+        start = time.monotonic()
+        with self.make_progressbar() as tq:
+            try:
+                asyncio.run(self.download_all(tq))
+            except KeyboardInterrupt as ex:
+                tq.close()
+                logger.warning("Stopping downloader tasks.")
+                self.stop_event.set()
+                raise ex from None
+
+        self.report_failures()
+        self.report_workers()
+        self.report_makespan(time.monotonic() - start)
+
+        return not self.failures
@@ -0,0 +1,212 @@
+import json
+import mmap
+import os
+import struct
+import threading
+from contextlib import AbstractContextManager
+from pathlib import Path
+
+from picomc.logging import logger
+from picomc.utils import atomic_write
+
+MAGIC = b"PMAI"
+FORMAT_VERSION = 1
+# magic, format version, flags, number of objects, number of distinct hashes,
+# sha1 of the source json
+HEADER = struct.Struct("<4sIIII20s")
+# sha1, size, offset and length of the name
+RECORD = struct.Struct("<20sQII")
+
+FLAG_VIRTUAL = 1
+FLAG_MAP_TO_RESOURCES = 2
+
+
+class AssetIndex:
+    """A compiled asset index. The objects are stored as an array of fixed
+    size records sorted by hash, followed by their names, in a file which is
+    memory mapped instead of parsed. Compiled indexes are kept next to the
+    json ones and recompiled whenever the hash of the source changes."""
+
+    def __init__(self, path):
+        with open(path, "rb") as fd:
+            self.buf = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, flags, self.count, self.distinct, sha1 = HEADER.unpack_from(
+                self.buf
+            )
+        except struct.error:
+            magic = version = None
+        if magic != MAGIC or version != FORMAT_VERSION:
+            self.buf.close()
+            raise ValueError("Not a compiled asset index")
+        self.source_sha1 = sha1.hex()
+        self.virtual = bool(flags & FLAG_VIRTUAL)
+        self.map_to_resources = bool(flags & FLAG_MAP_TO_RESOURCES)
+        self.names_start = HEADER.size + RECORD.size * self.count
+        if len(self.buf) < self.names_start:
+            self.buf.close()
+            raise ValueError("Truncated compiled asset index")
+        self.records = memoryview(self.buf)[HEADER.size : self.names_start]
+
+    def close(self):
+        self.records.release()
+        self.buf.close()
+
+    def __len__(self):
+        return self.count
+
+    def hashes(self):
+        """Yields the distinct objects as (sha1, size)."""
+        last = None
+        for sha1, size, _, _ in RECORD.iter_unpack(self.records):
+            if sha1 != last:
+                last = sha1
+                yield sha1.hex(), size
+
+    def objects(self):
+        """Yields all objects as (name, sha1, size)."""
+        buf = self.buf
+        start = self.names_start
+        for sha1, size, offset, length in RECORD.iter_unpack(self.records):
+            name = buf[start + offset : start + offset + length].decode()
+            yield name, sha1.hex(), size
+
+    @staticmethod
+    def compile(raw, source_sha1, path):
+        """Compiles the json asset index `raw` into `path`."""
+        index = json.loads(raw)
+        flags = 0
+        if index.get("virtual", False):
+            flags |= FLAG_VIRTUAL
+        if index.get("map_to_resources", False):
+            flags |= FLAG_MAP_TO_RESOURCES
+        objects = sorted(
+            (bytes.fromhex(obj["hash"]), obj["size"], name)
+            for name, obj in index["objects"].items()
+        )
+        distinct = len(set(sha1 for sha1, _, _ in objects))
+        records = bytearray()
+        names = bytearray()
+        for sha1, size, name in objects:
+            encoded = name.encode()
+            records += RECORD.pack(sha1, size, len(names), len(encoded))
+            names += encoded
+        header = HEADER.pack(
+            MAGIC,
+            FORMAT_VERSION,
+            flags,
+            len(objects),
+            distinct,
+            bytes.fromhex(source_sha1),
+        )
+        with atomic_write(path, "wb") as fd:
+            fd.write(header)
+            fd.write(records)
+            fd.write(names)
+
+    @classmethod
+    def open(cls, path, source_sha1):
+        """Returns the compiled index at `path`, or None if there is none or it
+        was compiled from a different source."""
+        try:
+            index = cls(path)
+        except (OSError, ValueError) as ex:
+            if not isinstance(ex, FileNotFoundError):
+                logger.debug("Ignoring compiled asset index {}: {}".format(path, ex))
+            return None
+        if index.source_sha1 != source_sha1:
+            index.close()
+            return None
+        return index
+
+
+class ObjectInventory(AbstractContextManager):
+    """The set of asset objects present in the objects directory, so that
+    checking for an object is a set lookup instead of a stat. It is stored in
+    the objects directory as a file of raw 20 byte hashes, to which the objects
+    added by downloads are appended on exit. The inventory is rebuilt by
+    scanning the directory if the file is missing, or on request."""
+
+    FILENAME = ".inventory"
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.path = self.root / self.FILENAME
+        self._hashes = None
+        self.added = []
+        self.rewrite = False
+        self.lock = threading.RLock()
+
+    @property
+    def hashes(self):
+        if self._hashes is None:
+            try:
+                with open(self.path, "rb") as fd:
+                    data = fd.read()
+            except FileNotFoundError:
+                self.reconcile()
+            else:
+                # An incomplete trailing record from an interrupted append is
+                # dropped.
+                self._hashes = set(
+                    data[i : i + 20] for i in range(0, len(data) - 19, 20)
+                )
+        return self._hashes
+
+    def __contains__(self, sha1):
+        return bytes.fromhex(sha1) in self.hashes
+
+    def __exit__(self, type, value, traceback):
+        self.save()
+
+    def add(self, sha1):
+        raw = bytes.fromhex(sha1)
+        with self.lock:
+            if raw not in self.hashes:
+                self.hashes.add(raw)
+                self.added.append(raw)
+
+    def discard(self, sha1):
+        raw = bytes.fromhex(sha1)
+        with self.lock:
+            if raw in self.hashes:
+                self.hashes.discard(raw)
+                self.rewrite = True
+
+    def notice(self, path, sha1):
+        """Adds a file to the inventory, if it is an object."""
+        path = Path(path)
+        if path.parent.parent == self.root and path.name == sha1:
+            self.add(sha1)
+
+    def reconcile(self):
+        """Rebuilds the inventory from the contents of the objects
+        directory."""
+        logger.debug("Scanning asset objects in {}".format(self.root))
+        hashes = set()
+        try:
+            prefixes = [e for e in os.scandir(self.root) if e.is_dir()]
+        except FileNotFoundError:
+            prefixes = []
+        for prefix in prefixes:
+            for entry in os.scandir(prefix.path):
+                if len(entry.name) != 40 or not entry.is_file():
+                    continue
+                try:
+                    hashes.add(bytes.fromhex(entry.name))
+                except ValueError:
+                    pass
+        with self.lock:
+            self._hashes = hashes
+            self.rewrite = True
+
+    def save(self):
+        with self.lock:
+            if self.rewrite:
+                with atomic_write(self.path, "wb") as fd:
+                    fd.write(b"".join(sorted(self._hashes)))
+            elif self.added:
+                with open(self.path, "ab") as fd:
+                    fd.write(b"".join(self.added))
+            self.added = []
+            self.rewrite = False
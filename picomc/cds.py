@@ -0,0 +1,91 @@
+import hashlib
+import json
+import os
+import time
+
+from picomc.hashcache import stat_key
+from picomc.java import get_major_version
+from picomc.logging import logger
+from picomc.utils import Directory
+
+# Dynamic archives, which are made from the classes loaded by a run of the
+# game, need Java 13.
+MIN_JAVA_VERSION = 13
+
+
+class ClassDataSharing:
+    """Application class data sharing (AppCDS) for a classpath. The first
+    launch records the classes it loads into an archive, which the JVM maps
+    instead of loading them from the jars on later launches. Archives are kept
+    in the cache, keyed by the classpath, the state of its jars and the java
+    runtime, and removed when they were not used for java.cds.max_age
+    days."""
+
+    def __init__(self, launcher, java_info, classpath):
+        self.launcher = launcher
+        self.java_info = java_info
+        self.root = launcher.get_path(Directory.CDS_CACHE)
+        self.path = self.root / "{}.jsa".format(self.get_key(classpath))
+        self.tmp = None
+
+    def get_key(self, classpath):
+        jars = []
+        for jar in classpath:
+            try:
+                jars.append([str(jar)] + stat_key(os.stat(jar)))
+            except FileNotFoundError:
+                jars.append([str(jar)])
+        inputs = [
+            self.java_info.get("java.home"),
+            self.java_info.get("java.vm.version"),
+            jars,
+        ]
+        return hashlib.sha1(json.dumps(inputs).encode()).hexdigest()
+
+    @classmethod
+    def is_supported(cls, java_info):
+        try:
+            major = int(get_major_version(java_info.get("java.version", "")))
+        except ValueError:
+            return False
+        return major >= MIN_JAVA_VERSION
+
+    def get_jvm_args(self):
+        if self.path.is_file():
+            logger.debug("Using CDS archive {}".format(self.path))
+            # Keeps it from being pruned.
+            os.utime(self.path)
+            return ["-XX:SharedArchiveFile={}".format(self.path)]
+        logger.info(
+            "Creating a class data sharing archive, "
+            "the game will take longer to exit this time."
+        )
+        # Written under a name of its own, concurrent launches could
+        # otherwise dump into the same file.
+        self.tmp = self.path.with_name("{}.{}.tmp".format(self.path.name, os.getpid()))
+        return ["-XX:ArchiveClassesAtExit={}".format(self.tmp)]
+
+    def finish(self, returncode):
+        """Keeps the archive dumped by the game, if it exited cleanly."""
+        if self.tmp is None:
+            return
+        try:
+            if returncode == 0 and self.tmp.is_file():
+                os.replace(self.tmp, self.path)
+                logger.debug("Created CDS archive {}".format(self.path))
+                self.prune()
+        finally:
+            if self.tmp.exists():
+                os.unlink(self.tmp)
+
+    def prune(self):
+        max_age = float(self.launcher.global_config["java.cds.max_age"]) * 86400
+        now = time.time()
+        for entry in os.scandir(self.root):
+            # Leftovers of crashed launches are old too.
+            if now - entry.stat().st_mtime > max_age:
+                logger.debug("Removing unused CDS archive {}".format(entry.path))
+                try:
+                    os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
@@ -2,8 +2,10 @@ from .account import register_account_cli
 from .config import register_config_cli
 from .instance import register_instance_cli
 from .main import picomc_cli
+from .mirror import register_mirror_cli
 from .mod import register_mod_cli
 from .play import register_play_cli
+from .prefetch import register_prefetch_cli
 from .version import register_version_cli
 
 register_account_cli(picomc_cli)
@@ -12,3 +14,5 @@ register_instance_cli(picomc_cli)
 register_config_cli(picomc_cli)
 register_mod_cli(picomc_cli)
 register_play_cli(picomc_cli)
+register_mirror_cli(picomc_cli)
+register_prefetch_cli(picomc_cli)
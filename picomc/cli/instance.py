@@ -80,7 +80,7 @@ def launch(am, im, instance_name, account, version_override, verify):
 @instance_cmd
 @pass_instance_manager
 def extract_natives(im, instance_name):
-    """Extract natives and leave them on disk."""
+    """Extract natives into the natives cache."""
     if not im.exists(instance_name):
         die("No such instance exists.")
     inst = im.get(instance_name)
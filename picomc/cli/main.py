@@ -5,6 +5,7 @@ from pathlib import Path
 import click
 
 from picomc import logging
+from picomc.downloader import parse_rate, parse_workers
 from picomc.launcher import Launcher
 from picomc.logging import logger
 
@@ -18,6 +19,26 @@ def print_version(printer):
     printer("Python {}".format(platform.python_version()))
 
 
+def click_validate_workers(ctx, param, value):
+    if value is None:
+        return value
+    try:
+        parse_workers(value)
+    except ValueError:
+        raise click.BadParameter("expected a positive integer or 'auto'")
+    return value
+
+
+def click_validate_rate(ctx, param, value):
+    if value is None:
+        return value
+    try:
+        parse_rate(value)
+    except ValueError:
+        raise click.BadParameter("expected a number of bytes per second, like 500K")
+    return value
+
+
 def click_print_version(ctx, param, value):
     if not value or ctx.resilient_parsing:
         return
@@ -29,6 +50,20 @@ def click_print_version(ctx, param, value):
 @click.group()
 @click.option("--debug/--no-debug", default=None)
 @click.option("-r", "--root", help="Application data directory.", default=None)
+@click.option(
+    "-w",
+    "--workers",
+    metavar="N|auto",
+    callback=click_validate_workers,
+    help="Number of concurrent downloads, overrides download.workers.",
+)
+@click.option(
+    "--limit-rate",
+    metavar="RATE",
+    callback=click_validate_rate,
+    help="Download rate limit in bytes per second (K, M and G suffixes), "
+    "overrides download.rate_limit.",
+)
 @click.option(
     "--version",
     is_flag=True,
@@ -37,7 +72,7 @@ def click_print_version(ctx, param, value):
     is_eager=True,
 )
 @click.pass_context
-def picomc_cli(ctx: click.Context, debug, root):
+def picomc_cli(ctx: click.Context, debug, root, workers, limit_rate):
     """picomc is a minimal CLI Minecraft launcher."""
     logging.initialize(debug)
 
@@ -55,4 +90,9 @@ def picomc_cli(ctx: click.Context, debug, root):
     launcher = launcher_cm.__enter__()
     ctx.call_on_close(partial(launcher_cm.__exit__, None, None, None))
 
+    if workers is not None:
+        launcher.override_download_settings(workers=parse_workers(workers))
+    if limit_rate is not None:
+        launcher.override_download_settings(rate_limit=parse_rate(limit_rate))
+
     ctx.obj = launcher
@@ -0,0 +1,27 @@
+import click
+
+from picomc.cli.utils import pass_launcher
+from picomc.mirror import serve_mirror
+
+
+@click.group()
+def mirror_cli():
+    """Share downloaded files with other machines."""
+    pass
+
+
+@mirror_cli.command()
+@click.option("-b", "--bind", default="0.0.0.0", help="Address to listen on.")
+@click.option("-p", "--port", type=int, default=8080, help="Port to listen on.")
+@pass_launcher
+def serve(launcher, bind, port):
+    """Serve the downloaded files as a read-only mirror.
+
+    Other machines use it by setting mirror.url to the address of this
+    machine, e.g. http://192.168.1.10:8080/. Files which were not
+    downloaded here are fetched by them from the original location."""
+    serve_mirror(launcher, bind, port)
+
+
+def register_mirror_cli(picomc_cli):
+    picomc_cli.add_command(mirror_cli, name="mirror")
@@ -0,0 +1,38 @@
+import click
+
+from picomc.cli.utils import pass_launcher
+from picomc.prefetch import Prefetcher
+from picomc.utils import die
+
+
+@click.command()
+@click.option("--once", is_flag=True, default=False, help="Prefetch once and exit.")
+@click.option(
+    "-i", "--interval", type=float, default=None, help="Seconds between checks."
+)
+@pass_launcher
+def prefetch(launcher, once, interval):
+    """Download the versions which will be played next, ahead of time.
+
+    The versions are set by prefetch.versions, by default the latest
+    release and snapshot, and the versions of all instances. Until
+    interrupted, the manifest is checked for new versions every
+    prefetch.interval seconds. Downloads are limited by
+    prefetch.rate_limit and prefetch.workers, unless --limit-rate or
+    --workers are given."""
+    prefetcher = Prefetcher(launcher)
+    if once:
+        try:
+            ok = prefetcher.run()
+        except RuntimeError as ex:
+            die(ex)
+        if not ok:
+            die("Some versions failed to prefetch.")
+        return
+    if interval is None:
+        interval = float(launcher.global_config["prefetch.interval"])
+    prefetcher.run(interval)
+
+
+def register_prefetch_cli(picomc_cli):
+    picomc_cli.add_command(prefetch)
@@ -6,8 +6,9 @@ import urllib.parse
 import click
 
 from picomc.cli.utils import pass_version_manager
+from picomc.downloader import DownloadQueue
 from picomc.logging import logger
-from picomc.utils import die, file_sha1
+from picomc.utils import die
 from picomc.version import VersionType
 
 
@@ -55,6 +56,8 @@ def list(vm, release, snapshot, alpha, beta, local, all):
 @click.option("--verify", is_flag=True, default=False)
 def prepare(version, verify):
     """Download required files for the version."""
+    if verify:
+        version = version.vm.get_version(version.version_name, verify=True)
     version.prepare(verify_hashes=verify)
 
 
@@ -76,9 +79,17 @@ def jar(version, which, output):
         die("Refusing to overwrite {}".format(output))
     logger.info("Hash (sha1) should be {}".format(sha1))
     logger.info("Downloading the {} file and saving to {}".format(which, output))
-    urllib.request.urlretrieve(dlspec["url"], output)
-    if file_sha1(output) != sha1:
-        logger.warning("Hash of downloaded file does not match")
+    q = DownloadQueue(version.launcher)
+    # The output is the user's file, which must not share the blob's inode.
+    q.add(
+        url,
+        os.path.abspath(output),
+        size=dlspec.get("size", None),
+        sha1=sha1,
+        hardlink=False,
+    )
+    if not q.download():
+        die("Failed to download the {} file".format(which))
 
 
 def register_version_cli(root_cli):
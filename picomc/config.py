@@ -23,10 +23,40 @@ def get_default_config():
         "java.path": get_default_java(),
         "java.memory.min": "512M",
         "java.memory.max": "2G",
+        "java.cds": False,
+        "java.cds.max_age": 30,
         "java.jvmargs": "-XX:+UnlockExperimentalVMOptions -XX:+UseG1GC -XX:G1NewSizePercent=20 -XX:G1ReservePercent=20 -XX:MaxGCPauseMillis=50 -XX:G1HeapRegionSize=32M",
+        "download.retries": 3,
+        "download.backoff": 0.5,
+        "download.timeout": 30,
+        "download.engine": "thread",
+        "download.host_connections": 16,
+        "download.workers": "auto",
+        "download.http2": True,
+        "download.rate_limit": 0,
+        "download.background_assets": False,
+        "mirror.url": "",
+        "mirror.rules": {},
+        "mirror.fallback": True,
+        "manifest.ttl": 3600,
+        "prefetch.versions": "latest snapshot instances",
+        "prefetch.interval": 600,
+        "prefetch.rate_limit": "1M",
+        "prefetch.workers": 2,
+        "natives.max_age": 30,
+        "game.resolution": "",
+        "game.demo": False,
     }
 
 
+def parse_bool(value):
+    """Interprets a config value as a boolean. Values set from the command
+    line are strings."""
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
+
 class ConfigManager(AbstractContextManager):
     def __init__(self, root):
         self.configs = dict()
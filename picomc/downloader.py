@@ -1,55 +1,792 @@
 import concurrent.futures
+import email.utils
+import enum
+import hashlib
+import json
 import os
+import random
+import re
 import shutil
-import tempfile
 import threading
+import time
+import urllib.parse
+from collections import Counter, defaultdict, deque
 from concurrent.futures import ThreadPoolExecutor
-from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Optional
 
 import certifi
 import urllib3
 from tqdm import tqdm
 
 import picomc.logging
+from picomc.config import parse_bool
 from picomc.logging import logger
+from picomc.mirror import get_mirror
 
+CONTENT_RANGE_RE = re.compile(r"bytes (\d+)-(\d+)/(\d+|\*)")
+RETRY_STATUSES = frozenset([408, 425, 429, 500, 502, 503, 504])
+# Smaller files are not worth recording upfront in a sidecar, they are simply
+# downloaded again if the process gets killed.
+SIDECAR_MIN_SIZE = 1024 * 1024
 
-@contextmanager
-def DlTempFile(*args, default_mode=0o666, try_delete=True, **kwargs):
-    """A NamedTemporaryFile which is created with permissions as per
-    the current umask. It is removed after exiting the context manager,
-    but only if it stil exists."""
-    if kwargs.get("delete", False):
-        raise ValueError("delete must be False")
-    kwargs["delete"] = False
-    f = tempfile.NamedTemporaryFile(*args, **kwargs)
-    umask = os.umask(0)
-    os.umask(umask)
-    os.chmod(f.name, default_mode & ~umask)
+
+class Priority(enum.IntEnum):
+    """Priority classes of queued files. Lower values are downloaded first."""
+
+    CRITICAL = 0
+    NORMAL = 1
+    BACKGROUND = 2
+
+
+RATE_SUFFIXES = {"": 1, "k": 1024, "m": 1024**2, "g": 1024**3}
+
+
+def parse_rate(value):
+    """Parses a transfer rate in bytes per second, optionally with a K, M or G
+    suffix, like 500K. Returns None for 0, which means unlimited."""
+    value = str(value).strip().lower()
+    if value.endswith("/s"):
+        value = value[:-2]
+    if value.endswith("b"):
+        value = value[:-1]
+    suffix = value[-1:] if value[-1:] in RATE_SUFFIXES else ""
+    rate = float(value[: len(value) - len(suffix)]) * RATE_SUFFIXES[suffix]
+    if rate < 0:
+        raise ValueError("The rate limit must not be negative")
+    return rate or None
+
+
+class TokenBucket:
+    """Limits the rate at which bytes are transferred, across all the
+    downloads sharing the bucket. The bytes are taken after they were read, so
+    the bucket may go into debt, which the reader has to wait out."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(64 * 1024, rate / 4)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, n):
+        """Takes `n` tokens. Returns the number of seconds to wait before
+        transferring more."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+
+def parse_workers(value):
+    """Parses the number of concurrent downloads, which is either a positive
+    integer or "auto". Returns None for the latter."""
+    if str(value).lower() == "auto":
+        return None
+    workers = int(value)
+    if workers < 1:
+        raise ValueError("The number of workers must be positive")
+    return workers
+
+
+@dataclass
+class DownloadSettings:
+    retries: int = 3
+    backoff: float = 0.5
+    backoff_max: float = 60.0
+    timeout: float = 30.0
+    engine: str = "thread"
+    host_connections: int = 16
+    # None selects the number of workers adaptively.
+    workers: Optional[int] = None
+    http2: bool = True
+    # Bytes per second for all downloads together, None for unlimited
+    rate_limit: Optional[float] = None
+    _bucket: Optional[TokenBucket] = field(default=None, repr=False, compare=False)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            retries=int(config["download.retries"]),
+            backoff=float(config["download.backoff"]),
+            timeout=float(config["download.timeout"]),
+            engine=config["download.engine"],
+            host_connections=int(config["download.host_connections"]),
+            workers=parse_workers(config["download.workers"]),
+            http2=parse_bool(config["download.http2"]),
+            rate_limit=parse_rate(config["download.rate_limit"]),
+        )
+
+    def get_bucket(self):
+        """Returns the token bucket shared by all downloads using these
+        settings, or None if the rate is not limited."""
+        if not self.rate_limit:
+            return None
+        if self._bucket is None or self._bucket.rate != self.rate_limit:
+            self._bucket = TokenBucket(self.rate_limit)
+        return self._bucket
+
+
+@dataclass
+class DownloadItem:
+    url: str
+    dest: Path
+    size: Optional[int] = None
+    sha1: Optional[str] = None
+    priority: Priority = Priority.NORMAL
+    # The original URL of a mirrored file, tried if the mirror fails
+    fallback_url: Optional[str] = None
+    # The attempt at which the current URL was first tried
+    retry_base: int = 0
+    # Whether the file may share its inode with its blob in the store
+    hardlink: bool = True
+
+
+@dataclass
+class DownloadFailure:
+    url: str
+    dest: Path
+    reason: str
+    status: Optional[int] = None
+    attempts: int = 1
+    priority: Priority = Priority.NORMAL
+
+
+class DownloadError(Exception):
+    def __init__(self, reason, status=None, retryable=True, retry_after=None):
+        super().__init__(reason)
+        self.status = status
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+class PartialDownload:
+    """A partially downloaded file. It lives next to its destination with a
+    `.part` suffix, accompanied by a small json sidecar which describes the
+    download it belongs to. Unlike a temporary file, it survives failures and
+    interruptions, so that the download can be resumed later."""
+
+    def __init__(self, item):
+        self.item = item
+        self.path = "{}.part".format(item.dest)
+        self.sidecar = "{}.json".format(self.path)
+        self.has_meta = False
+
+    def resume_offset(self):
+        """Returns the number of already downloaded bytes which can be reused.
+        The partial file is discarded if it does not belong to this download."""
+        try:
+            with open(self.sidecar) as fd:
+                meta = json.load(fd)
+            written = os.path.getsize(self.path)
+        except FileNotFoundError:
+            # A partial file without a sidecar gets overwritten.
+            return 0
+        except (OSError, ValueError):
+            self.discard()
+            return 0
+        expected_size = self.item.size
+        if (
+            meta.get("url") != self.item.url
+            or meta.get("size") != expected_size
+            or meta.get("sha1") != self.item.sha1
+            or (expected_size is not None and written >= expected_size)
+        ):
+            self.discard()
+            return 0
+        return written
+
+    def hash_existing(self):
+        """Returns a sha1 object fed with the already downloaded bytes, so that
+        hashing can continue with the rest of the stream."""
+        h = hashlib.sha1()
+        with open(self.path, "rb", buffering=0) as fd:
+            for b in iter(lambda: fd.read(128 * 1024), b""):
+                h.update(b)
+        return h
+
+    def begin(self, offset):
+        size = self.item.size
+        if self.has_meta or size is None or size >= SIDECAR_MIN_SIZE:
+            self.save_meta(offset)
+
+    def save_meta(self, written):
+        self.has_meta = True
+        with open(self.sidecar, "w") as fd:
+            meta = {
+                "url": self.item.url,
+                "size": self.item.size,
+                "sha1": self.item.sha1,
+                "written": written,
+            }
+            json.dump(meta, fd)
+
+    def discard(self):
+        for path in (self.path, self.sidecar):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def commit(self):
+        os.replace(self.path, self.item.dest)
+        if self.has_meta:
+            os.unlink(self.sidecar)
+
+
+class ItemProgress:
+    """Reports the progress of a single file. Bytes which were already reported
+    during a previous attempt are not reported again."""
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.pos = 0
+        self.reported = 0
+
+    def seek(self, pos):
+        self.pos = pos
+        self.advance(0)
+
+    def advance(self, n):
+        self.pos += n
+        if self.pos > self.reported:
+            self.callback(self.pos - self.reported)
+            self.reported = self.pos
+
+
+class ConcurrencyController:
+    """Chooses the number of concurrent downloads from the observed throughput,
+    in the style of TCP congestion control. Starting small, the limit doubles
+    as long as the throughput improves substantially, then it grows by one at a
+    time while there are more downloads waiting. A high error rate, or latency
+    spikes which bring no additional throughput, halve the limit.
+
+    The engines report transferred bytes, response latencies and errors, and
+    call update periodically to reevaluate the limit."""
+
+    INITIAL = 4
+    MAXIMUM = 128
+    INTERVAL = 0.5
+    # Relative throughput improvement expected from a higher limit
+    GAIN = 1.1
+    # Latency relative to the lowest one seen, which is considered congestion
+    LATENCY_SPIKE = 3.0
+    # Some errors happen regardless of the load and should not cause a backoff.
+    ERROR_RATE = 0.1
+
+    def __init__(self, initial=INITIAL, maximum=MAXIMUM, interval=INTERVAL):
+        self.limit = initial
+        self.maximum = maximum
+        self.interval = interval
+        self.peak = initial
+        self.adjustments = 0
+        self.slow_start = True
+        self.last_rate = 0.0
+        # The lowest mean latency of each host seen in a sample
+        self.min_latency = dict()
+        self.lock = threading.Lock()
+        self.reset_sample(time.monotonic())
+
+    def reset_sample(self, now):
+        self.sample_start = now
+        self.sample_bytes = 0
+        self.sample_latency = defaultdict(float)
+        self.sample_responses = Counter()
+        self.errors = 0
+        self.saturated = False
+
+    def on_bytes(self, n):
+        with self.lock:
+            self.sample_bytes += n
+
+    def on_response(self, host, latency):
+        with self.lock:
+            self.sample_latency[host] += latency
+            self.sample_responses[host] += 1
+
+    def on_error(self):
+        with self.lock:
+            self.errors += 1
+
+    def on_saturated(self):
+        """Records that there were more downloads waiting than the limit
+        allowed to run. Only then does the throughput tell anything about the
+        benefit of a higher limit."""
+        self.saturated = True
+
+    def update(self):
+        """Reevaluates the limit once per interval. Returns whether it
+        changed."""
+        with self.lock:
+            now = time.monotonic()
+            elapsed = now - self.sample_start
+            if elapsed < self.interval:
+                return False
+            old_limit = self.limit
+            self.adjust(self.sample_bytes / elapsed)
+            self.reset_sample(now)
+            if self.limit == old_limit:
+                return False
+            self.adjustments += 1
+            self.peak = max(self.peak, self.limit)
+            return True
+
+    def adjust(self, rate):
+        # Hosts differ in latency, so each one is compared to its own best.
+        latency = baseline = 0.0
+        for host, n in self.sample_responses.items():
+            mean = self.sample_latency[host] / n
+            best = min(mean, self.min_latency.get(host, mean))
+            self.min_latency[host] = best
+            latency += self.sample_latency[host]
+            baseline += best * n
+        # Requests queueing up somewhere without any throughput to show for it
+        latency_spike = (
+            latency > self.LATENCY_SPIKE * baseline
+            and rate < self.last_rate * self.GAIN
+        )
+        requests = sum(self.sample_responses.values()) + self.errors
+        error_rate = self.errors / requests if requests else 0.0
+        if error_rate > self.ERROR_RATE or latency_spike:
+            self.limit = max(1, self.limit // 2)
+            self.slow_start = False
+        elif not self.saturated:
+            return
+        elif self.slow_start and rate <= self.last_rate * self.GAIN:
+            self.slow_start = False
+        elif self.slow_start:
+            self.limit = min(self.maximum, self.limit * 2)
+        else:
+            self.limit = min(self.maximum, self.limit + 1)
+        self.last_rate = rate
+
+
+def parse_retry_after(value):
+    """Parses the value of a Retry-After header, which is either a number of
+    seconds or a HTTP date. Returns the delay in seconds or None."""
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
     try:
-        with f as uf:
-            yield uf
-    finally:
-        if try_delete and os.path.exists(f.name):
-            os.unlink(f.name)
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
+
+
+def get_range_start(resp):
+    """Returns the first byte position of a 206 Partial Content response."""
+    match = CONTENT_RANGE_RE.fullmatch(resp.headers.get("Content-Range", ""))
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+def fair_shares(demands, total):
+    """Divides `total` slots among the keys of `demands` using max-min
+    fairness: no key gets more than it demands and the rest is split
+    evenly."""
+    shares = dict()
+    remaining = total
+    by_demand = sorted(demands, key=demands.get)
+    for n, key in enumerate(by_demand):
+        share = min(demands[key], remaining // (len(by_demand) - n))
+        shares[key] = share
+        remaining -= share
+    return shares
+
 
+def get_ideal_makespan(durations, workers):
+    """Returns a lower bound of the time it takes to process jobs of the given
+    durations with the given number of parallel workers."""
+    if not durations:
+        return 0.0
+    return max(max(durations), sum(durations) / max(1, workers))
 
-class Downloader:
-    def __init__(self, queue, total_size=None, workers=16):
+
+def largest_first(entry):
+    # Files of unknown size might be large, so they come first.
+    _, item = entry
+    return (item.size is not None, -(item.size or 0))
+
+
+class HostScheduler:
+    """Decides which queued files to download next. Each host has its own
+    queue and a limit on concurrent downloads, and the free slots are shared
+    fairly among the hosts, so that a slow host cannot hold all of them while
+    the files from a fast host wait.
+
+    Within a host, the largest files go first (LPT scheduling). The small ones
+    fill the remaining slots around them, instead of a big file which happens
+    to be queued last becoming the long tail of the whole download.
+
+    Files of a lower priority class are only started when there are free slots
+    left after all files of the higher classes which can run have started."""
+
+    def __init__(self, queue, host_limit):
+        self.host_limit = host_limit
+        # Pending files by priority class, then by host
+        self.pending = dict()
+        for i, item in sorted(enumerate(queue, start=1), key=largest_first):
+            hosts = self.pending.setdefault(item.priority, dict())
+            hosts.setdefault(self.get_host(item), deque()).append((i, item))
+        # The order in which hosts take turns within each class
+        self.turns = {prio: deque(hosts) for prio, hosts in self.pending.items()}
+        self.running = Counter()
+        # The host each running file was taken for, its URL may change later
+        self.running_hosts = dict()
+        self.peak = 0
+
+    @staticmethod
+    def get_host(item):
+        return urllib.parse.urlsplit(item.url).netloc
+
+    def get_demands(self, priority=None):
+        """Returns the number of downloads each host could run right now,
+        considering the files of the given priority or higher."""
+        demands = Counter(self.running)
+        for prio, hosts in self.pending.items():
+            if priority is None or prio <= priority:
+                for host, queue in hosts.items():
+                    demands[host] += len(queue)
+        return {host: min(self.host_limit, n) for host, n in demands.items()}
+
+    def is_saturated(self, limit):
+        """Returns whether more downloads could run if `limit` was higher."""
+        return sum(self.get_demands().values()) > limit
+
+    def take(self, limit):
+        """Returns the files to start, keeping the total number of running
+        downloads within `limit`."""
+        taken = []
+        free = limit - sum(self.running.values())
+        for priority in sorted(self.pending):
+            if free <= 0:
+                break
+            hosts = self.pending[priority]
+            turns = self.turns[priority]
+            shares = fair_shares(self.get_demands(priority), limit)
+            while free > 0 and turns:
+                host = turns[0]
+                turns.rotate(-1)
+                if self.running[host] >= shares[host]:
+                    # Every host with pending files has reached its share
+                    if all(self.running[h] >= shares[h] for h in turns):
+                        break
+                    continue
+                queue = hosts[host]
+                i, item = queue.popleft()
+                taken.append((i, item))
+                self.running_hosts[id(item)] = host
+                self.running[host] += 1
+                free -= 1
+                if not queue:
+                    del hosts[host]
+                    turns.remove(host)
+            if not hosts:
+                del self.pending[priority]
+                del self.turns[priority]
+        self.peak = max(self.peak, sum(self.running.values()))
+        return taken
+
+    def done(self, item):
+        host = self.running_hosts.pop(id(item))
+        self.running[host] -= 1
+        if not self.running[host]:
+            del self.running[host]
+
+
+class BaseDownloader:
+    """Bookkeeping shared by the download engines: resuming partial files,
+    verification of the result, retries and failure reporting. The engines
+    themselves only move the bytes."""
+
+    def __init__(self, queue, total_size=None, settings=None, store=None):
         self.queue = queue
+        self.settings = settings or DownloadSettings()
+        self.store = store
         self.total = len(queue)
         self.known_size = total_size is not None
         if self.known_size:
             self.total_size = total_size
-        self.errors = list()
-        self.workers = workers
-        self.fut_to_url = dict()
+        self.failures = list()
+        self.verified = list()
+        self.durations = list()
+        self.makespan = None
+        self.ideal_makespan = None
+        self.stop_event = threading.Event()
+        self.progressbar = True
+        self.bucket = self.settings.get_bucket()
+        # Mirror hosts which could not be reached, their files go straight to
+        # the original URL.
+        self.dead_mirrors = set()
+        self.mirror_lock = threading.Lock()
+        self.scheduler = HostScheduler(queue, self.settings.host_connections)
+        # Files not yet done in each priority class, and events which are set
+        # once a class and all the higher ones are done.
+        self.remaining = Counter(item.priority for item in queue)
+        self.classes_done = {priority: threading.Event() for priority in Priority}
+        self.update_classes_done()
+        if self.settings.workers is None:
+            self.controller = ConcurrencyController()
+            self.max_workers = self.controller.maximum
+        else:
+            self.controller = None
+            self.max_workers = self.settings.workers
+
+    @property
+    def workers(self):
+        """The current limit of concurrent downloads."""
+        if self.controller is not None:
+            return self.controller.limit
+        return self.settings.workers
+
+    @property
+    def poll_interval(self):
+        if self.controller is not None:
+            return self.controller.interval
+        return None
+
+    def make_callback(self, tq):
+        """Returns the callback receiving the number of downloaded bytes."""
+        controller = self.controller
+        if controller is None:
+            return tq.update if self.known_size else (lambda x: None)
+        elif self.known_size:
+
+            def callback(n):
+                controller.on_bytes(n)
+                tq.update(n)
+
+            return callback
+        else:
+            return controller.on_bytes
+
+    def item_done(self, item, duration):
+        """Records that a file is done, either downloaded or failed."""
+        self.scheduler.done(item)
+        self.durations.append(duration)
+        self.remaining[item.priority] -= 1
+        self.update_classes_done()
+
+    def update_classes_done(self):
+        pending = 0
+        for priority in sorted(Priority):
+            pending += self.remaining[priority]
+            if not pending:
+                self.classes_done[priority].set()
+
+    def set_classes_done(self):
+        """Releases everyone waiting for a class, used when the downloader
+        stops early."""
+        for event in self.classes_done.values():
+            event.set()
+
+    def throttle(self, n):
+        """Accounts for `n` transferred bytes in the rate limit. Returns the
+        number of seconds to wait."""
+        if self.bucket is None:
+            return 0.0
+        return self.bucket.consume(n)
+
+    def on_response(self, item, latency):
+        if self.controller is not None:
+            self.controller.on_response(self.scheduler.get_host(item), latency)
+
+    def update_workers(self, saturated):
+        if self.controller is None:
+            return
+        if saturated:
+            self.controller.on_saturated()
+        if self.controller.update():
+            logger.debug("Adjusted concurrent downloads to {}".format(self.workers))
+
+    def report_makespan(self, makespan):
+        self.makespan = makespan
+        self.ideal_makespan = get_ideal_makespan(self.durations, self.scheduler.peak)
+        logger.debug(
+            "Downloads took {:.2f}s, the ideal with {} workers is {:.2f}s.".format(
+                self.makespan, self.scheduler.peak, self.ideal_makespan
+            )
+        )
+
+    def report_workers(self):
+        if self.controller is None or not self.controller.adjustments:
+            return
+        logger.info(
+            "Settled on {} concurrent downloads (peak {}).".format(
+                self.workers, self.controller.peak
+            )
+        )
+
+    def make_progressbar(self):
+        disable_progressbar = picomc.logging.debug or not self.progressbar
+        if self.known_size:
+            return tqdm(
+                total=self.total_size,
+                disable=disable_progressbar,
+                unit_divisor=1024,
+                unit="iB",
+                unit_scale=True,
+            )
+        else:
+            return tqdm(total=self.total, disable=disable_progressbar)
+
+    def get_backoff(self, attempt):
+        # Exponential backoff with full jitter
+        cap = min(self.settings.backoff_max, self.settings.backoff * 2**attempt)
+        return random.uniform(0, cap)
+
+    def get_retry_delay(self, item, ex, attempt):
+        """Decides whether a failed attempt should be retried. Returns the delay
+        before the next attempt, or None after recording the failure."""
+        retryable = getattr(ex, "retryable", True)
+        if retryable and self.controller is not None:
+            self.controller.on_error()
+        # Attempts at the current URL
+        tries = attempt - item.retry_base
+        exhausted = tries >= self.settings.retries
+        if item.fallback_url is not None:
+            host = self.scheduler.get_host(item)
+            # The mirror is not worth waiting for when it cannot be reached,
+            # unlike the original location.
+            if not isinstance(ex, DownloadError):
+                with self.mirror_lock:
+                    if host not in self.dead_mirrors:
+                        logger.warning(
+                            "Mirror {} is not reachable, "
+                            "using the original locations.".format(host)
+                        )
+                        self.dead_mirrors.add(host)
+            if not retryable or exhausted or host in self.dead_mirrors:
+                logger.debug("Mirror failed ({}): {}".format(ex, item.url))
+                self.use_fallback(item, attempt + 1)
+                return 0.0
+        if not retryable or exhausted:
+            self.failures.append(
+                DownloadFailure(
+                    url=item.url,
+                    dest=item.dest,
+                    reason=str(ex) or type(ex).__name__,
+                    status=getattr(ex, "status", None),
+                    attempts=attempt + 1,
+                    priority=item.priority,
+                )
+            )
+            return None
+        delay = getattr(ex, "retry_after", None)
+        if delay is None:
+            delay = self.get_backoff(tries)
+        delay = min(delay, self.settings.backoff_max)
+        logger.debug(
+            "Retrying in {:.1f}s ({}/{}), {}: {}".format(
+                delay, tries + 1, self.settings.retries, ex, item.url
+            )
+        )
+        return delay
+
+    def use_fallback(self, item, attempt):
+        """Switches a mirrored file to its original URL, with a fresh set of
+        retries starting at `attempt`."""
+        logger.debug("Falling back to {}".format(item.fallback_url))
+        item.url, item.fallback_url = item.fallback_url, None
+        item.retry_base = attempt
+
+    def start_attempt(self, i, item):
+        """Returns the partial download, the offset to resume at and the
+        request headers to use."""
+        if (
+            item.fallback_url is not None
+            and self.scheduler.get_host(item) in self.dead_mirrors
+        ):
+            self.use_fallback(item, item.retry_base)
+        os.makedirs(os.path.dirname(item.dest), exist_ok=True)
+        partial = PartialDownload(item)
+        offset = partial.resume_offset()
+        headers = {}
+        if offset:
+            headers["Range"] = "bytes={}-".format(offset)
+            logger.debug(
+                "Resuming at {} bytes [{}/{}]: {}".format(
+                    offset, i, self.total, item.url
+                )
+            )
+        else:
+            logger.debug("Downloading [{}/{}]: {}".format(i, self.total, item.url))
+        return partial, offset, headers
+
+    def accept_response(self, item, partial, offset, resp):
+        """Checks the response status. Returns the offset at which the body
+        starts, the file mode and the digest to continue with. Returns None if
+        the partial file had to be discarded and the attempt should restart."""
+        if offset and resp.status == 206 and get_range_start(resp) == offset:
+            return offset, "ab", partial.hash_existing()
+        elif resp.status == 200:
+            # The server ignored our Range header, start from scratch.
+            return 0, "wb", hashlib.sha1()
+        elif offset and resp.status == 416:
+            logger.debug("Range not satisfiable, restarting: {}".format(item.url))
+            partial.discard()
+            return None
+        else:
+            raise DownloadError(
+                "HTTP status {}".format(resp.status),
+                status=resp.status,
+                retryable=resp.status in RETRY_STATUSES,
+                retry_after=parse_retry_after(resp.headers.get("Retry-After")),
+            )
+
+    def finish(self, item, partial, written, digest):
+        if item.size is not None and written != item.size:
+            partial.discard()
+            raise DownloadError("Size mismatch ({} != {})".format(written, item.size))
+        if item.sha1 is not None and digest.hexdigest() != item.sha1:
+            partial.discard()
+            raise DownloadError("Hash mismatch")
+        partial.commit()
+        if item.sha1 is not None:
+            self.verified.append(item)
+            if self.store is not None:
+                self.store.adopt(item.dest, item.sha1, hardlink=item.hardlink)
+
+    def report_failures(self):
+        # Do this at the end in order to not break the progress bar.
+        for failure in self.failures:
+            logger.error(
+                "Failed to download ({}, {} attempts): {}".format(
+                    failure.reason, failure.attempts, failure.url
+                )
+            )
+
+
+class Downloader(BaseDownloader):
+    def __init__(self, queue, total_size=None, settings=None, store=None):
+        super().__init__(queue, total_size=total_size, settings=settings, store=store)
+        self.fut_to_item = dict()
+        self.fut_started = dict()
         self.http_pool = urllib3.PoolManager(
-            cert_reqs="CERT_REQUIRED", ca_certs=certifi.where()
+            maxsize=min(self.max_workers, self.settings.host_connections),
+            cert_reqs="CERT_REQUIRED",
+            ca_certs=certifi.where(),
+            timeout=urllib3.Timeout(connect=10.0, read=self.settings.timeout),
+            # Failures are retried by download_file, with a backoff.
+            retries=urllib3.Retry(
+                connect=0, read=0, redirect=5, respect_retry_after_header=False
+            ),
         )
-        self.stop_event = threading.Event()
 
-    def copyfileobj_prog(self, fsrc, fdst, callback, length=0):
+    def copyfileobj_prog(self, fsrc, fdst, callback, length=0, digest=None):
         if not length:
             # COPY_BUFSIZE is undocumented and requires python 3.8
             length = getattr(shutil, "COPY_BUFSIZE", 64 * 1024)
@@ -64,35 +801,68 @@ class Downloader:
             if not buf:
                 break
             fdst_write(buf)
+            if digest is not None:
+                digest.update(buf)
             callback(len(buf))
+            delay = self.throttle(len(buf))
+            if delay and self.stop_event.wait(delay):
+                raise InterruptedError
 
-    def download_file(self, i, url, dest, sz_callback):
-        # In case the task could not be cancelled
-        if self.stop_event.is_set():
-            raise InterruptedError
-        os.makedirs(os.path.dirname(dest), exist_ok=True)
-        logger.debug("Downloading [{}/{}]: {}".format(i, self.total, url))
-        resp = self.http_pool.request("GET", url, preload_content=False)
-        if resp.status != 200:
-            self.errors.append(
-                "Failed to download ({}) [{}/{}]: {}".format(
-                    resp.status, i, self.total, url
-                )
-            )
+    def download_file(self, i, item, sz_callback):
+        progress = ItemProgress(sz_callback)
+        attempt = 0
+        while True:
+            # In case the task could not be cancelled
+            if self.stop_event.is_set():
+                raise InterruptedError
+            try:
+                self.fetch(i, item, progress)
+                return
+            except InterruptedError:
+                raise
+            except (DownloadError, urllib3.exceptions.HTTPError, OSError) as ex:
+                delay = self.get_retry_delay(item, ex, attempt)
+                if delay is None:
+                    return
+                attempt += 1
+                if self.stop_event.wait(delay):
+                    raise InterruptedError
+
+    def fetch(self, i, item, progress):
+        partial, offset, headers = self.start_attempt(i, item)
+        start = time.monotonic()
+        resp = self.http_pool.request(
+            "GET", item.url, headers=headers, preload_content=False
+        )
+        self.on_response(item, time.monotonic() - start)
+        try:
+            accepted = self.accept_response(item, partial, offset, resp)
+            if accepted is None:
+                resp.release_conn()
+                return self.fetch(i, item, progress)
+            offset, mode, digest = accepted
+            progress.seek(offset)
+            partial.begin(offset)
+            with open(partial.path, mode) as fd:
+                try:
+                    self.copyfileobj_prog(resp, fd, progress.advance, digest=digest)
+                except BaseException:
+                    partial.save_meta(fd.tell())
+                    raise
+                written = fd.tell()
+        finally:
             resp.release_conn()
-            return
-        with DlTempFile(dir=os.path.dirname(dest), delete=False) as tempf:
-            self.copyfileobj_prog(resp, tempf, sz_callback)
-            tempf.close()
-            os.replace(tempf.name, dest)
-        resp.release_conn()
+        self.finish(item, partial, written, digest)
 
     def reap_future(self, future, tq):
+        item = self.fut_to_item[future]
+        self.item_done(item, time.monotonic() - self.fut_started.pop(future))
         try:
             future.result()
         except Exception as ex:
-            msg = f"Exception while downloading {self.fut_to_url[future]}: {ex}"
-            self.errors.append(msg)
+            self.failures.append(
+                DownloadFailure(item.url, item.dest, str(ex), priority=item.priority)
+            )
         else:
             if not self.known_size:
                 tq.update(1)
@@ -104,51 +874,112 @@ class Downloader:
         logger.warning("Stopping downloader threads.")
         self.stop_event.set()
         tpe.shutdown()
-        for fut in self.fut_to_url:
+        for fut in self.fut_to_item:
             fut.cancel()
 
     def download(self):
         logger.debug("Downloading {} files.".format(self.total))
-        disable_progressbar = picomc.logging.debug
-
-        if self.known_size:
-            cm_progressbar = tqdm(
-                total=self.total_size,
-                disable=disable_progressbar,
-                unit_divisor=1024,
-                unit="iB",
-                unit_scale=True,
-            )
-        else:
-            cm_progressbar = tqdm(total=self.total, disable=disable_progressbar)
-
-        with cm_progressbar as tq, ThreadPoolExecutor(max_workers=self.workers) as tpe:
-            for i, (url, dest) in enumerate(self.queue, start=1):
-                cb = tq.update if self.known_size else (lambda x: None)
-                fut = tpe.submit(self.download_file, i, url, dest, cb)
-                self.fut_to_url[fut] = url
 
+        start = time.monotonic()
+        with self.make_progressbar() as tq, ThreadPoolExecutor(
+            max_workers=self.max_workers
+        ) as tpe:
+            cb = self.make_callback(tq)
+            running = set()
             try:
-                for fut in concurrent.futures.as_completed(self.fut_to_url.keys()):
-                    self.reap_future(fut, tq)
+                while True:
+                    # Only as many files as there are workers are submitted at
+                    # a time, so that the limit can change in the meantime.
+                    for i, item in self.scheduler.take(self.workers):
+                        fut = tpe.submit(self.download_file, i, item, cb)
+                        self.fut_to_item[fut] = item
+                        self.fut_started[fut] = time.monotonic()
+                        running.add(fut)
+                    if not running:
+                        break
+                    done, running = concurrent.futures.wait(
+                        running,
+                        timeout=self.poll_interval,
+                        return_when=concurrent.futures.FIRST_COMPLETED,
+                    )
+                    for fut in done:
+                        self.reap_future(fut, tq)
+                    self.update_workers(
+                        saturated=self.scheduler.is_saturated(self.workers)
+                    )
             except KeyboardInterrupt as ex:
                 self.cancel(tq, tpe)
                 raise ex from None
 
-        # Do this at the end in order to not break the progress bar.
-        for error in self.errors:
-            logger.error(error)
+        self.report_failures()
+        self.report_workers()
+        self.report_makespan(time.monotonic() - start)
 
-        return not self.errors
+        return not self.failures
 
 
 class DownloadQueue:
-    def __init__(self):
+    def __init__(self, launcher=None):
         self.q = []
+        # Queued items by destination, None for files linked from the store
+        self.dests = dict()
         self.size = 0
+        self.verified = []
+        self.failures = []
+        self.workers = None
+        self.makespan = None
+        self.ideal_makespan = None
+        self.downloader = None
+        self.thread = None
+        if launcher is not None:
+            self.settings = launcher.download_settings
+            self.store = launcher.blob_store
+            self.hash_cache = launcher.hash_cache
+            self.inventory = launcher.asset_inventory
+        else:
+            self.settings = DownloadSettings()
+            self.store = None
+            self.hash_cache = None
+            self.inventory = None
 
-    def add(self, url, filename, size=None):
-        self.q.append((url, filename))
+    def add(
+        self,
+        url,
+        filename,
+        size=None,
+        sha1=None,
+        priority=Priority.NORMAL,
+        hardlink=True,
+    ):
+        """Queues a file. Files which may be modified in place, like configs
+        in a game directory, have to be queued without `hardlink`, so that
+        they do not share an inode with their blob in the store."""
+        # Two downloads into the same file would clobber each other's
+        # partial file, so only the first one is kept.
+        if filename in self.dests:
+            item = self.dests[filename]
+            if item is not None:
+                item.priority = min(item.priority, priority)
+            return
+        self.dests[filename] = None
+        if self.store is not None and sha1 is not None:
+            if self.store.link_to(sha1, filename, hardlink=hardlink):
+                self.record(filename, sha1)
+                return
+        mirror = get_mirror()
+        mirrored = mirror.rewrite(url)
+        fallback_url = url if mirrored != url and mirror.fallback else None
+        item = DownloadItem(
+            mirrored,
+            filename,
+            size,
+            sha1,
+            Priority(priority),
+            fallback_url,
+            hardlink=hardlink,
+        )
+        self.dests[filename] = item
+        self.q.append(item)
         if self.size is not None and size is not None:
             self.size += size
         else:
@@ -157,7 +988,70 @@ class DownloadQueue:
     def __len__(self):
         return len(self.q)
 
+    def record(self, path, sha1):
+        """Records a file which is known to have the given hash."""
+        if self.hash_cache is not None:
+            self.hash_cache.record(path, sha1)
+        if self.inventory is not None:
+            self.inventory.notice(path, sha1)
+
+    def count(self, priority):
+        """Returns the number of queued files of the given priority class."""
+        return sum(1 for item in self.q if item.priority == priority)
+
+    def make_downloader(self):
+        if self.settings.engine == "asyncio":
+            from picomc.aiodownloader import AsyncDownloader as engine
+        else:
+            engine = Downloader
+        return engine(
+            self.q, total_size=self.size, settings=self.settings, store=self.store
+        )
+
+    def collect_results(self):
+        downloader = self.downloader
+        self.verified = downloader.verified
+        self.failures = downloader.failures
+        for item in self.verified:
+            self.record(item.dest, item.sha1)
+        self.workers = downloader.workers
+        self.makespan = downloader.makespan
+        self.ideal_makespan = downloader.ideal_makespan
+
     def download(self):
         if not self.q:
             return True
-        return Downloader(self.q, total_size=self.size).download()
+        self.downloader = self.make_downloader()
+        ok = self.downloader.download()
+        self.collect_results()
+        return ok
+
+    def start(self):
+        """Starts downloading in a background thread, without a progress bar.
+        Use wait to find out when the files, or a class of them, are done."""
+        self.downloader = self.make_downloader()
+        self.downloader.progressbar = False
+        self.thread = threading.Thread(target=self.run_background, daemon=True)
+        self.thread.start()
+
+    def run_background(self):
+        try:
+            if self.q:
+                self.downloader.download()
+        except Exception as ex:
+            logger.error("Background download failed: {}".format(ex))
+        finally:
+            self.downloader.set_classes_done()
+            self.collect_results()
+
+    def wait(self, priority=None):
+        """Waits until all files of the given priority class and the classes
+        above it are done, or all files if priority is None. Returns whether
+        they were all downloaded successfully."""
+        if self.thread is None:
+            return not self.failures
+        if priority is None:
+            self.thread.join()
+            return not self.failures
+        self.downloader.classes_done[priority].wait()
+        return not any(f.priority <= priority for f in self.downloader.failures)
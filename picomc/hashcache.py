@@ -0,0 +1,174 @@
+import json
+import os
+import struct
+import threading
+from contextlib import AbstractContextManager
+
+from picomc.logging import logger
+from picomc.utils import atomic_write, file_sha1
+
+# Raw hash, size, modification time and inode of an object
+OBJECT_RECORD = struct.Struct("<20sQqQ")
+
+
+def stat_key(st):
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+class HashCache(AbstractContextManager):
+    """Remembers the sha1 hashes of files, keyed by their size, modification
+    time and inode, so that a file is only hashed again once it changes. The
+    cache is loaded on first use and written out on exit, if it changed.
+
+    Files in the `objects` directory are named by their hash, like the asset
+    objects. There are thousands of them, so they are kept out of the cache
+    file, in a compact table of raw hashes and stats next to them. Only the
+    objects which match their name are remembered there."""
+
+    OBJECTS_FILENAME = ".hashes"
+
+    def __init__(self, path, objects=None):
+        self.path = path
+        self.objects = os.path.join(objects, "") if objects is not None else None
+        self._entries = None
+        self._object_entries = None
+        self.dirty = False
+        self.objects_dirty = False
+        self.lock = threading.Lock()
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            try:
+                with open(self.path) as fd:
+                    self._entries = json.load(fd)
+            except FileNotFoundError:
+                self._entries = dict()
+            except (OSError, ValueError) as ex:
+                logger.debug("Discarding the hash cache: {}".format(ex))
+                self._entries = dict()
+            if self.objects is not None:
+                # Written by versions which kept the objects in here
+                objects = [k for k in self._entries if k.startswith(self.objects)]
+                for key in objects:
+                    del self._entries[key]
+                self.dirty = self.dirty or bool(objects)
+        return self._entries
+
+    @property
+    def objects_path(self):
+        return os.path.join(self.objects, self.OBJECTS_FILENAME)
+
+    @property
+    def object_entries(self):
+        """The stats of the objects, by their raw hash."""
+        if self._object_entries is None:
+            try:
+                with open(self.objects_path, "rb") as fd:
+                    data = fd.read()
+            except FileNotFoundError:
+                data = b""
+            except OSError as ex:
+                logger.debug("Discarding the object hashes: {}".format(ex))
+                data = b""
+            # An incomplete trailing record is dropped.
+            end = len(data) - len(data) % OBJECT_RECORD.size
+            self._object_entries = {
+                sha1: list(st)
+                for sha1, *st in OBJECT_RECORD.iter_unpack(memoryview(data)[:end])
+            }
+        return self._object_entries
+
+    def get_object_hash(self, key):
+        """Returns the raw hash which the object at `key` is named by, or None
+        if it is not an object."""
+        if self.objects is None or not key.startswith(self.objects):
+            return None
+        name = os.path.basename(key)
+        if len(name) != 40:
+            return None
+        try:
+            return bytes.fromhex(name)
+        except ValueError:
+            return None
+
+    def __exit__(self, type, value, traceback):
+        self.save_if_dirty()
+
+    def sha1(self, path):
+        """Returns the sha1 hash of the file at `path`, hashing it only if it
+        changed since it was last hashed."""
+        key = str(path)
+        st = os.stat(path)
+        raw = self.get_object_hash(key)
+        with self.lock:
+            if raw is not None:
+                if self.object_entries.get(raw) == stat_key(st):
+                    return raw.hex()
+            else:
+                entry = self.entries.get(key)
+                if entry is not None and entry[:3] == stat_key(st):
+                    return entry[3]
+        sha1 = file_sha1(path)
+        self.put(key, st, sha1)
+        return sha1
+
+    def check(self, path, sha1):
+        """Returns whether the file at `path` exists and has the given
+        hash."""
+        try:
+            return self.sha1(path) == sha1
+        except FileNotFoundError:
+            return False
+
+    def record(self, path, sha1):
+        """Records the hash of a file which was verified in another way, like
+        while it was being downloaded."""
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return
+        self.put(str(path), st, sha1)
+
+    def put(self, key, st, sha1):
+        raw = self.get_object_hash(key)
+        with self.lock:
+            if raw is None:
+                self.entries[key] = stat_key(st) + [sha1]
+                self.dirty = True
+            elif raw.hex() == sha1:
+                self.object_entries[raw] = stat_key(st)
+                self.objects_dirty = True
+
+    def prune(self):
+        """Drops the entries of files which no longer exist."""
+        for key in list(self.entries):
+            if not os.path.exists(key):
+                del self.entries[key]
+
+    def prune_objects(self):
+        for raw in list(self.object_entries):
+            sha1 = raw.hex()
+            if not os.path.exists(os.path.join(self.objects, sha1[0:2], sha1)):
+                del self.object_entries[raw]
+
+    def save_if_dirty(self):
+        if self.dirty:
+            self.prune()
+            logger.debug("Writing hash cache to {}".format(self.path))
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with atomic_write(self.path) as fd:
+                json.dump(self.entries, fd, separators=(",", ":"))
+            self.dirty = False
+        if self.objects_dirty:
+            self.prune_objects()
+            logger.debug("Writing object hashes to {}".format(self.objects_path))
+            os.makedirs(self.objects, exist_ok=True)
+            with atomic_write(self.objects_path, "wb") as fd:
+                fd.write(
+                    b"".join(
+                        OBJECT_RECORD.pack(raw, *st)
+                        for raw, st in self.object_entries.items()
+                    )
+                )
+            self.objects_dirty = False
@@ -0,0 +1,104 @@
+import json
+import time
+from pathlib import Path
+
+import requests
+
+from picomc import mirror
+from picomc.logging import logger
+from picomc.utils import atomic_write
+
+
+class CachedFile:
+    """A remote file cached on disk. Its HTTP validators (ETag and
+    Last-Modified) are kept in a sidecar, so that it can be revalidated with a
+    conditional request. Within `ttl` seconds of the last check, the cached
+    copy is used without any network access."""
+
+    def __init__(self, url, path, ttl=0, timeout=None):
+        self.url = url
+        self.path = Path(path)
+        self.meta_path = Path("{}.http.json".format(path))
+        self.ttl = ttl
+        self.timeout = timeout
+
+    def load_meta(self):
+        try:
+            with open(self.meta_path) as fd:
+                meta = json.load(fd)
+        except (OSError, ValueError):
+            return dict()
+        if meta.get("url") != self.url or not self.path.is_file():
+            return dict()
+        return meta
+
+    def save_meta(self, meta):
+        with atomic_write(self.meta_path) as fd:
+            json.dump(meta, fd)
+
+    def read(self):
+        with open(self.path, "rb") as fd:
+            return fd.read()
+
+    def is_fresh(self, meta):
+        return bool(meta) and time.time() - meta.get("checked", 0) < self.ttl
+
+    def get_fresh(self):
+        """Returns the contents of the cached copy if it is fresh, or None. It
+        never accesses the network."""
+        if self.is_fresh(self.load_meta()):
+            return self.read()
+        return None
+
+    def write(self, content):
+        with atomic_write(self.path, "wb") as fd:
+            fd.write(content)
+
+    def get(self):
+        """Returns the contents of the file, which are fetched or revalidated
+        if the cached copy is not fresh. If that fails, a stale copy is used
+        if there is any."""
+        meta = self.load_meta()
+        now = time.time()
+        if self.is_fresh(meta):
+            logger.debug(
+                "Using cached {}, checked {:.0f}s ago".format(
+                    self.path.name, now - meta["checked"]
+                )
+            )
+            return self.read()
+        headers = dict()
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        try:
+            resp = mirror.get(self.url, headers=headers, timeout=self.timeout)
+            if resp.status_code == 304 and meta:
+                logger.debug("Cached {} is up to date".format(self.path.name))
+                meta["checked"] = now
+                self.save_meta(meta)
+                return self.read()
+            if resp.status_code != 200:
+                raise requests.HTTPError(
+                    "HTTP status {}".format(resp.status_code), response=resp
+                )
+        except requests.RequestException as ex:
+            if not self.path.is_file():
+                raise
+            logger.warning(
+                "Failed to retrieve {} ({}), using the cached copy.".format(
+                    self.path.name, ex
+                )
+            )
+            return self.read()
+        self.write(resp.content)
+        self.save_meta(
+            {
+                "url": self.url,
+                "etag": resp.headers.get("ETag"),
+                "last_modified": resp.headers.get("Last-Modified"),
+                "checked": now,
+            }
+        )
+        return resp.content
@@ -1,10 +1,14 @@
+import hashlib
+import json
 import os
 import shlex
 import shutil
 import subprocess
+import time
 import zipfile
 from operator import attrgetter
 from pathlib import Path
+from secrets import token_hex
 from string import Template
 from tempfile import mkdtemp
 
@@ -12,12 +16,22 @@ import requests
 
 import picomc
 from picomc import logging
+from picomc.cds import ClassDataSharing
+from picomc.config import parse_bool
 from picomc.errors import RefreshError
 from picomc.java import assert_java
 from picomc.logging import logger
-from picomc.rules import match_ruleset
+from picomc.osinfo import osinfo
+from picomc.rules import RuleEnv, match_ruleset
+from picomc.stamp import PrepareStamp
 from picomc.utils import Directory, join_classpath, sanitize_name
 
+# Invalidates the natives cache when the way natives are extracted changes
+NATIVES_FORMAT = 1
+# References older than this are left over from launches which did not exit
+# cleanly, nobody plays for a week straight.
+NATIVES_STALE_REF_AGE = 7 * 86400
+
 
 class InstanceError(Exception):
     pass
@@ -28,47 +42,134 @@ class InstanceNotFoundError(InstanceError):
 
 
 class NativesExtractor:
-    def __init__(self, libraries_root, instance, natives):
-        self.libraries_root = libraries_root
-        self.instance = instance
-        self.natives = natives
-        self.ndir = mkdtemp(prefix="natives-", dir=instance.get_relpath())
-
-    def get_natives_path(self):
-        return self.ndir
+    """Extracts natives archives into a directory of the natives cache, which
+    is keyed by the archives and the platform, so that they are only extracted
+    once for all launches and instances. While the game runs, the launch holds
+    a reference to the directory. Directories which were not used for
+    natives.max_age days are removed once nothing refers to them."""
 
-    def extract(self):
-        dedup = set()
+    def __init__(self, launcher, natives):
+        self.launcher = launcher
+        self.root = launcher.get_path(Directory.NATIVES)
+        self.natives = list(natives)
+        self.archives = self.get_archives()
+        self.key = self.get_key()
+        self.ndir = self.root / self.key
+        self.ref = None
+
+    def get_archives(self):
+        """Returns the natives archives, without duplicates, as (path, sha1,
+        exclude)."""
+        libraries_root = self.launcher.get_path(Directory.LIBRARIES)
+        archives = dict()
         for library in self.natives:
-            fullpath = library.get_abspath(self.libraries_root)
-            if fullpath in dedup:
+            fullpath = library.get_abspath(libraries_root)
+            if fullpath in archives:
                 logger.debug(
                     "Skipping duplicate natives archive: " "{}".format(fullpath)
                 )
                 continue
-            dedup.add(fullpath)
-            logger.debug("Extracting natives archive: {}".format(fullpath))
-            with zipfile.ZipFile(fullpath) as zf:
-                # TODO take exclude into account
-                zf.extractall(path=self.ndir)
+            sha1 = self.launcher.hash_cache.sha1(fullpath)
+            archives[fullpath] = (fullpath, sha1, library.extract_exclude)
+        return list(archives.values())
+
+    def get_key(self):
+        inputs = [
+            NATIVES_FORMAT,
+            osinfo.platform,
+            osinfo.arch,
+            sorted([sha1, sorted(exclude)] for _, sha1, exclude in self.archives),
+        ]
+        return hashlib.sha1(json.dumps(inputs).encode()).hexdigest()
+
+    def get_natives_path(self):
+        return self.ndir
+
+    def extract(self):
+        if self.ndir.is_dir():
+            logger.debug("Using cached natives: {}".format(self.ndir))
+            # Keeps it from being pruned.
+            os.utime(self.ndir)
+            return
+        # Extracted next to the final directory and renamed into place, so
+        # that concurrent launches never see a partial directory.
+        tmp = mkdtemp(prefix=".natives-", dir=self.root)
+        try:
+            for fullpath, _, exclude in self.archives:
+                logger.debug("Extracting natives archive: {}".format(fullpath))
+                with zipfile.ZipFile(fullpath) as zf:
+                    for member in zf.infolist():
+                        if any(member.filename.startswith(e) for e in exclude):
+                            continue
+                        zf.extract(member, path=tmp)
+            try:
+                os.rename(tmp, self.ndir)
+            except OSError:
+                if not self.ndir.is_dir():
+                    raise
+                logger.debug("Natives were extracted by another launch.")
+        finally:
+            if os.path.exists(tmp):
+                shutil.rmtree(tmp)
+
+    def get_refs_path(self):
+        return self.root / ".refs"
+
+    def acquire(self):
+        refs = self.get_refs_path()
+        refs.mkdir(exist_ok=True)
+        self.ref = refs / "{}.{}.{}".format(self.key, os.getpid(), token_hex(4))
+        self.ref.touch()
+
+    def release(self):
+        try:
+            self.ref.unlink()
+        except FileNotFoundError:
+            pass
+        self.ref = None
+
+    def prune(self):
+        """Removes the directories which were not used for natives.max_age
+        days and have no references."""
+        max_age = float(self.launcher.global_config["natives.max_age"]) * 86400
+        now = time.time()
+        referenced = set()
+        for entry in os.scandir(self.get_refs_path()):
+            if now - entry.stat().st_mtime > NATIVES_STALE_REF_AGE:
+                # Another launch may be pruning at the same time.
+                try:
+                    os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
+            else:
+                referenced.add(entry.name.split(".")[0])
+        for entry in os.scandir(self.root):
+            if entry.name == ".refs" or entry.name in referenced:
+                continue
+            if entry.is_dir() and now - entry.stat().st_mtime > max_age:
+                logger.debug("Removing unused natives: {}".format(entry.path))
+                shutil.rmtree(entry.path, ignore_errors=True)
 
     def __enter__(self):
+        # The reference comes first, so that the directory can not be pruned
+        # between extracting and using it.
+        self.acquire()
         self.extract()
-        return self.ndir
+        return str(self.ndir)
 
     def __exit__(self, ext_type, exc_value, traceback):
-        logger.debug("Cleaning up natives.")
-        shutil.rmtree(self.ndir)
+        self.release()
+        self.prune()
 
 
-def process_arguments(arguments_dict, java_info):
+def process_arguments(arguments_dict, env):
     def subproc(obj):
         args = []
         for a in obj:
             if isinstance(a, str):
                 args.append(a)
             else:
-                if "rules" in a and not match_ruleset(a["rules"], java_info):
+                if "rules" in a and not match_ruleset(a["rules"], env):
                     continue
                 if isinstance(a["value"], list):
                     args.extend(a["value"])
@@ -106,9 +207,30 @@ class Instance:
     def set_version(self, version):
         self.config["version"] = version
 
+    def get_resolution(self):
+        """Returns the configured window size as (width, height), or None."""
+        value = self.config["game.resolution"]
+        if not value:
+            return None
+        try:
+            width, height = (int(x) for x in value.lower().split("x"))
+        except ValueError:
+            logger.warning("Ignoring invalid game.resolution {}".format(value))
+            return None
+        return width, height
+
+    def get_features(self):
+        """Returns the features enabled for the rules of the vspec."""
+        features = set()
+        if parse_bool(self.config["game.demo"]):
+            features.add("is_demo_user")
+        if self.get_resolution() is not None:
+            features.add("has_custom_resolution")
+        return features
+
     def launch(self, account, version=None, verify_hashes=False):
         vobj = self.launcher.version_manager.get_version(
-            version or self.config["version"]
+            version or self.config["version"], verify=verify_hashes
         )
         logger.info("Launching instance: {}".format(self.name))
         if version or vobj.version_name == self.config["version"]:
@@ -127,32 +249,55 @@ class Instance:
         java_info = assert_java(java, vobj.java_version)
 
         libraries = vobj.get_libraries(java_info)
-        vobj.prepare_launch(gamedir, java_info, verify_hashes)
+        background_assets = parse_bool(self.config["download.background_assets"])
+        stamp = PrepareStamp(self.get_relpath("prepared.json"))
+        digest, files = vobj.get_prepare_inputs(java_info, gamedir)
+        pending = None
+        if not verify_hashes and stamp.is_current(digest):
+            logger.debug("Nothing changed since the last launch, skipping prepare.")
+        else:
+            pending = vobj.prepare_launch(
+                gamedir, java_info, verify_hashes, background_assets
+            )
+            if pending.thread is None:
+                if not pending.failures:
+                    stamp.save(digest, files)
+                pending = None
         # Do this here so that configs are not needlessly overwritten after
         # the game quits
         self.launcher.config_manager.commit_all_dirty()
-        with NativesExtractor(
-            self.libraries_root, self, filter(attrgetter("is_native"), libraries)
-        ) as natives_dir:
-            self._exec_mc(
-                account,
-                vobj,
-                java,
-                java_info,
-                gamedir,
-                filter(attrgetter("is_classpath"), libraries),
-                natives_dir,
-                verify_hashes,
-            )
+        try:
+            with NativesExtractor(
+                self.launcher, filter(attrgetter("is_native"), libraries)
+            ) as natives_dir:
+                self._exec_mc(
+                    account,
+                    vobj,
+                    java,
+                    java_info,
+                    gamedir,
+                    filter(attrgetter("is_classpath"), libraries),
+                    natives_dir,
+                    verify_hashes,
+                )
+        finally:
+            if pending is not None and self.wait_background_downloads(pending):
+                stamp.save(digest, files)
+
+    def wait_background_downloads(self, pending):
+        if pending.thread.is_alive():
+            logger.info("Waiting for background downloads to finish.")
+        if not pending.wait():
+            logger.warning("Some assets failed to download.")
+            return False
+        return True
 
     def extract_natives(self):
         vobj = self.launcher.version_manager.get_version(self.config["version"])
         java_info = assert_java(self.get_java(), vobj.java_version)
         vobj.download_libraries(java_info, verify_hashes=True)
         libs = vobj.get_libraries(java_info)
-        ne = NativesExtractor(
-            self.libraries_root, self, filter(attrgetter("is_native"), libs)
-        )
+        ne = NativesExtractor(self.launcher, filter(attrgetter("is_native"), libs))
         ne.extract()
         logger.info("Extracted natives to {}".format(ne.get_natives_path()))
 
@@ -168,12 +313,21 @@ class Instance:
         )
 
         mc = v.vspec.mainClass
+        features = self.get_features()
+        resolution = self.get_resolution()
 
         if hasattr(v.vspec, "minecraftArguments"):
             mcargs = shlex.split(v.vspec.minecraftArguments)
             sjvmargs = ["-Djava.library.path={}".format(natives), "-cp", classpath]
+            # Old versions have no rules for these, they are always supported.
+            if "is_demo_user" in features:
+                mcargs.append("--demo")
+            if "has_custom_resolution" in features:
+                mcargs += ["--width", "${resolution_width}"]
+                mcargs += ["--height", "${resolution_height}"]
         elif hasattr(v.vspec, "arguments"):
-            mcargs, jvmargs = process_arguments(v.vspec.arguments, java_info)
+            env = RuleEnv.create(java_info, features)
+            mcargs, jvmargs = process_arguments(v.vspec.arguments, env)
             sjvmargs = []
             for a in jvmargs:
                 tmpl = Template(a)
@@ -218,6 +372,8 @@ class Instance:
                 game_assets=v.get_virtual_asset_path(),
                 clientid="",  # TODO fill these out properly
                 auth_xuid="",
+                resolution_width=resolution[0] if resolution else "",
+                resolution_height=resolution[1] if resolution else "",
             )
             smcargs.append(res)
 
@@ -231,12 +387,22 @@ class Instance:
 
         my_jvm_args += shlex.split(self.config["java.jvmargs"])
 
+        cds = None
+        if parse_bool(self.config["java.cds"]):
+            if ClassDataSharing.is_supported(java_info):
+                cds = ClassDataSharing(self.launcher, java_info, libs)
+                my_jvm_args += cds.get_jvm_args()
+            else:
+                logger.warning("Class data sharing needs at least Java 13.")
+
         fargs = [java] + sjvmargs + my_jvm_args + [mc] + smcargs
         if logging.debug:
             logger.debug("Launching: " + shlex.join(fargs))
         else:
             logger.info("Launching the game")
-        subprocess.run(fargs, cwd=gamedir)
+        proc = subprocess.run(fargs, cwd=gamedir)
+        if cds is not None:
+            cds.finish(proc.returncode)
 
 
 class InstanceManager:
@@ -1 +1 @@
-from .javainfo import assert_java, get_java_info
+from .javainfo import assert_java, get_java_info, get_major_version
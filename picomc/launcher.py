@@ -3,9 +3,14 @@ from contextlib import ExitStack, contextmanager
 from pathlib import Path, PurePath
 
 from picomc.account import AccountManager
+from picomc.assetindex import ObjectInventory
 from picomc.config import Config, ConfigManager
+from picomc.downloader import DownloadSettings
+from picomc.hashcache import HashCache
 from picomc.instance import InstanceManager
 from picomc.logging import logger
+from picomc.mirror import set_mirror_config
+from picomc.store import BlobStore
 from picomc.utils import Directory, cached_property
 from picomc.version import VersionManager
 from picomc.windows import get_appdata
@@ -32,8 +37,13 @@ DIRECTORY_MAP = {
     Directory.ASSET_INDEXES: PurePath("assets", "indexes"),
     Directory.ASSET_OBJECTS: PurePath("assets", "objects"),
     Directory.ASSET_VIRTUAL: PurePath("assets", "virtual"),
+    Directory.CACHE: PurePath("cache"),
+    Directory.CDS_CACHE: PurePath("cache", "cds"),
     Directory.INSTANCES: PurePath("instances"),
     Directory.LIBRARIES: PurePath("libraries"),
+    Directory.LIBRARY_CACHE: PurePath("cache", "libraries"),
+    Directory.NATIVES: PurePath("cache", "natives"),
+    Directory.STORE: PurePath("store"),
     Directory.VERSIONS: PurePath("versions"),
 }
 
@@ -42,6 +52,9 @@ class Launcher:
     root: Path
     exit_stack: ExitStack
     debug: bool
+    # Download settings given on the command line, which take precedence over
+    # any config
+    download_overrides: dict
 
     @cached_property
     def config_manager(self) -> ConfigManager:
@@ -59,10 +72,39 @@ class Launcher:
     def instance_manager(self) -> InstanceManager:
         return InstanceManager(self)
 
+    @cached_property
+    def blob_store(self) -> BlobStore:
+        return BlobStore(self.get_path(Directory.STORE), hash_cache=self.hash_cache)
+
+    @cached_property
+    def hash_cache(self) -> HashCache:
+        return self.exit_stack.enter_context(
+            HashCache(
+                self.get_path(Directory.CACHE, "hashes.json"),
+                objects=self.get_path(Directory.ASSET_OBJECTS),
+            )
+        )
+
+    @cached_property
+    def asset_inventory(self) -> ObjectInventory:
+        return self.exit_stack.enter_context(
+            ObjectInventory(self.get_path(Directory.ASSET_OBJECTS))
+        )
+
     @cached_property
     def global_config(self) -> Config:
         return self.config_manager.global_config
 
+    @cached_property
+    def download_settings(self) -> DownloadSettings:
+        return DownloadSettings.from_config(self.global_config)
+
+    def override_download_settings(self, **overrides):
+        """Sets download settings given on the command line."""
+        self.download_overrides.update(overrides)
+        for name, value in overrides.items():
+            setattr(self.download_settings, name, value)
+
     @classmethod
     @contextmanager
     def new(cls, *args, **kwargs):
@@ -75,11 +117,13 @@ class Launcher:
         """Create a Launcher instance reusing an existing ExitStack."""
         self.exit_stack = exit_stack
         self.debug = debug
+        self.download_overrides = dict()
         if root is None:
             root = get_default_root()
         self.root = root
         logger.debug("Using application directory: {}".format(self.root))
         self.ensure_filesystem()
+        set_mirror_config(self.global_config)
 
     def get_path(self, *pathsegments) -> Path:
         """Constructs a path relative to the Launcher root. `pathsegments` is
@@ -1,3 +1,4 @@
+import functools
 import urllib.parse
 from dataclasses import dataclass
 from pathlib import Path, PurePosixPath
@@ -53,6 +54,41 @@ class Artifact:
         return Path(base) / self.path
 
 
+def get_library_key(descriptor):
+    """Returns the group, artifact and classifier of a maven descriptor, which
+    identify a library regardless of its version."""
+    descriptor = descriptor.split("@")[0]
+    group, art_id, _, *class_ = descriptor.split(":")
+    return group, art_id, class_[0] if class_ else None
+
+
+def merge_libraries(libraries):
+    """Drops the libraries which have the same group, artifact and classifier
+    as one before them, so that the first wins. The libraries of a vspec come
+    before those of the vspecs it inherits from."""
+    merged = dict()
+    for library in libraries:
+        key = get_library_key(library.descriptor)
+        if key in merged:
+            logger.debug(
+                "Dropping library {}, {} takes precedence".format(
+                    library.descriptor, merged[key].descriptor
+                )
+            )
+            continue
+        merged[key] = library
+    dropped = len(libraries) - len(merged)
+    if dropped:
+        logger.info("Dropped {} duplicate libraries.".format(dropped))
+    return list(merged.values())
+
+
+@functools.lru_cache(maxsize=None)
+def get_arch_bits():
+    # platform.architecture may run `file` on the interpreter to find out.
+    return architecture()[0][:2]
+
+
 class Library:
     MOJANG_BASE_URL = "https://libraries.minecraft.net/"
 
@@ -64,6 +100,8 @@ class Library:
         js = self.json_lib
         self.descriptor = js["name"]
         self.is_native = "natives" in js
+        # Path prefixes in the natives archive which are not extracted
+        self.extract_exclude = js.get("extract", dict()).get("exclude", [])
         self.is_classpath = not (self.is_native or js.get("presenceOnly", False))
         self.base_url = js.get("url", Library.MOJANG_BASE_URL)
 
@@ -73,7 +111,7 @@ class Library:
         if self.is_native:
             try:
                 classifier_tmpl = self.json_lib["natives"][osinfo.platform]
-                arch = architecture()[0][:2]
+                arch = get_arch_bits()
                 self.native_classifier = Template(classifier_tmpl).substitute(arch=arch)
                 self.descriptor = self.descriptor + ":" + self.native_classifier
             except KeyError:
@@ -126,5 +164,41 @@ class Library:
             except KeyError:
                 return None
 
+    def to_dict(self):
+        """Returns the resolved library, for the library cache. Only available
+        libraries can be stored."""
+        return {
+            "descriptor": self.descriptor,
+            "is_native": self.is_native,
+            "is_classpath": self.is_classpath,
+            "extract_exclude": self.extract_exclude,
+            "path": self.path.as_posix(),
+            "url": self.url,
+            "sha1": self.sha1,
+            "size": self.size,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        """Makes a library from the output of to_dict, without resolving it
+        again."""
+        lib = cls.__new__(cls)
+        lib.json_lib = None
+        lib.descriptor = d["descriptor"]
+        lib.is_native = d["is_native"]
+        lib.is_classpath = d["is_classpath"]
+        lib.extract_exclude = d["extract_exclude"]
+        lib.available = True
+        lib.path = PurePosixPath(d["path"])
+        lib.filename = lib.path.name
+        lib.virt_artifact = Artifact(
+            url=None, path=lib.path, sha1=None, size=None, filename=lib.filename
+        )
+        lib.artifact = None
+        lib.url = d["url"]
+        lib.sha1 = d["sha1"]
+        lib.size = d["size"]
+        return lib
+
     def get_abspath(self, library_root):
         return self.virt_artifact.get_localpath(library_root)
@@ -0,0 +1,264 @@
+import http.server
+import itertools
+import json
+import os
+import re
+import urllib.parse
+from pathlib import PurePosixPath
+
+import requests
+
+from picomc.config import parse_bool
+from picomc.logging import logger
+from picomc.utils import Directory
+
+SHA1_RE = re.compile(r"[0-9a-f]{40}")
+RANGE_RE = re.compile(r"bytes=(\d+)-(\d*)")
+
+
+class Mirror:
+    """Rewrites the URLs of remote files to a mirror, such as an HTTP cache on
+    the local network. Each rule maps a URL prefix to a replacement and the
+    longest matching prefix wins. With a base URL, every other URL is mapped to
+    `<base>/<host>/<path>`, which is the layout served by `picomc mirror
+    serve`."""
+
+    def __init__(self, base=None, rules=None, fallback=True):
+        self.base = base.rstrip("/") + "/" if base else None
+        self.rules = sorted(
+            (rules or dict()).items(), key=lambda rule: len(rule[0]), reverse=True
+        )
+        self.fallback = fallback
+
+    @classmethod
+    def from_config(cls, config):
+        rules = config["mirror.rules"]
+        # Values set from the command line are strings.
+        if isinstance(rules, str):
+            try:
+                rules = json.loads(rules) if rules.strip() else dict()
+            except ValueError as ex:
+                logger.warning("Ignoring malformed mirror.rules: {}".format(ex))
+                rules = dict()
+        if not isinstance(rules, dict) or not all(
+            isinstance(rule, str) for rule in itertools.chain(*rules.items())
+        ):
+            logger.warning(
+                "Ignoring mirror.rules, it has to map URL prefixes to replacements"
+            )
+            rules = dict()
+        return cls(
+            base=config["mirror.url"] or None,
+            rules=rules,
+            fallback=parse_bool(config["mirror.fallback"]),
+        )
+
+    def rewrite(self, url):
+        """Returns the mirrored URL, or `url` itself if it is not mirrored."""
+        for prefix, replacement in self.rules:
+            if url.startswith(prefix):
+                return replacement + url[len(prefix) :]
+        if self.base is None or url.startswith(self.base):
+            return url
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.netloc:
+            return url
+        mirrored = self.base + parts.netloc + parts.path
+        if parts.query:
+            mirrored += "?" + parts.query
+        return mirrored
+
+
+_mirror = Mirror()
+# The config to build the mirror from when it is first used, see
+# set_mirror_config()
+_mirror_config = None
+
+
+def get_mirror():
+    global _mirror, _mirror_config
+    if _mirror_config is not None:
+        _mirror = Mirror.from_config(_mirror_config)
+        _mirror_config = None
+    return _mirror
+
+
+def set_mirror(mirror):
+    """Makes `mirror` the one used for all remote files of this process."""
+    global _mirror, _mirror_config
+    _mirror = mirror
+    _mirror_config = None
+
+
+def set_mirror_config(config):
+    """Makes the mirror configured in `config` the one used for all remote
+    files of this process. It is only built once something is downloaded, so
+    commands which do not download, like fixing the config, do not depend on
+    it."""
+    global _mirror_config
+    _mirror_config = config
+
+
+def request(method, url, **kwargs):
+    """Sends a request through the mirror. Unless disabled, the original URL
+    is tried if the mirror fails or does not have the file."""
+    mirror = get_mirror()
+    mirrored = mirror.rewrite(url)
+    if mirrored == url:
+        return requests.request(method, url, **kwargs)
+    try:
+        resp = requests.request(method, mirrored, **kwargs)
+    except requests.RequestException as ex:
+        if not mirror.fallback:
+            raise
+        logger.debug("Mirror failed ({}), falling back: {}".format(ex, url))
+    else:
+        if resp.ok or not mirror.fallback:
+            return resp
+        logger.debug(
+            "Mirror returned HTTP status {}, falling back: {}".format(
+                resp.status_code, url
+            )
+        )
+        resp.close()
+    return requests.request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+class MirrorRoot:
+    """Finds the files of a launcher root by their upstream URL, in the layout
+    produced by `Mirror` with a base URL. Only files which were downloaded
+    before can be found, anything else is left to the fallback of the
+    clients."""
+
+    # Leading path components which some maven repositories have on top of
+    # the layout of the libraries directory, like forge's /maven/
+    MAVEN_PREFIXES = 2
+
+    def __init__(self, launcher):
+        self.launcher = launcher
+
+    def resolve(self, urlpath):
+        """Returns the local path of the file, or None."""
+        path = urllib.parse.unquote(urllib.parse.urlsplit(urlpath).path)
+        parts = PurePosixPath(path).parts[1:]
+        if len(parts) < 2 or any(
+            part in ("..", ".") or "\\" in part or os.sep in part for part in parts
+        ):
+            return None
+        rest = parts[1:]
+        for part in rest:
+            if SHA1_RE.fullmatch(part):
+                return self.resolve_hashed(part, rest[-1])
+        for n in range(min(self.MAVEN_PREFIXES, len(rest) - 1) + 1):
+            candidate = self.launcher.get_path(Directory.LIBRARIES, *rest[n:])
+            if candidate.is_file():
+                return candidate
+        return None
+
+    def resolve_hashed(self, sha1, name):
+        """Resolves a content-addressed URL, like those of the asset objects,
+        client jars, version jsons and asset indexes."""
+        candidates = [
+            self.launcher.blob_store.get_path(sha1),
+            self.launcher.get_path(Directory.ASSET_OBJECTS, sha1[0:2], sha1),
+        ]
+        for candidate in candidates:
+            if candidate.is_file():
+                return candidate
+        # Version jsons and asset indexes are stored by name, so their hash
+        # has to be checked.
+        stem = PurePosixPath(name).stem
+        candidates = [
+            self.launcher.get_path(Directory.VERSIONS, stem, name),
+            self.launcher.get_path(Directory.ASSET_INDEXES, name),
+        ]
+        for candidate in candidates:
+            if self.launcher.hash_cache.check(candidate, sha1):
+                return candidate
+        return None
+
+
+class MirrorRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    root: MirrorRoot
+
+    def do_HEAD(self):
+        self.send_file(head=True)
+
+    def do_GET(self):
+        self.send_file(head=False)
+
+    def send_file(self, head):
+        path = self.root.resolve(self.path)
+        if path is None:
+            self.send_error(404)
+            return
+        try:
+            fd = open(path, "rb")
+        except OSError:
+            self.send_error(404)
+            return
+        with fd:
+            size = os.fstat(fd.fileno()).st_size
+            start, end = 0, size - 1
+            match = RANGE_RE.fullmatch(self.headers.get("Range", ""))
+            if match is not None:
+                start = int(match.group(1))
+                if match.group(2):
+                    end = min(end, int(match.group(2)))
+                if start > end:
+                    self.send_response(416)
+                    self.send_header("Content-Range", "bytes */{}".format(size))
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header(
+                    "Content-Range", "bytes {}-{}/{}".format(start, end, size)
+                )
+            else:
+                self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("Accept-Ranges", "bytes")
+            self.end_headers()
+            if head:
+                return
+            fd.seek(start)
+            remaining = end - start + 1
+            while remaining:
+                buf = fd.read(min(remaining, 256 * 1024))
+                if not buf:
+                    break
+                self.wfile.write(buf)
+                remaining -= len(buf)
+
+    def log_message(self, fmt, *args):
+        logger.debug("{} {}".format(self.address_string(), fmt % args))
+
+
+def serve_mirror(launcher, bind, port):
+    """Serves the files of the launcher root as a read-only mirror until
+    interrupted."""
+    handler = type("Handler", (MirrorRequestHandler,), {"root": MirrorRoot(launcher)})
+    server = http.server.ThreadingHTTPServer((bind, port), handler)
+    server.daemon_threads = True
+    host, port = server.server_address[:2]
+    logger.info(
+        "Serving {} as a mirror on http://{}:{}/".format(launcher.root, host, port)
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
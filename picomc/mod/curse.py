@@ -10,9 +10,9 @@ from xml.etree import ElementTree
 from zipfile import ZipFile
 
 import click
-import requests
 from tqdm import tqdm
 
+from picomc import mirror
 from picomc.cli.utils import pass_instance_manager, pass_launcher
 from picomc.downloader import DownloadQueue
 from picomc.logging import logger
@@ -27,7 +27,7 @@ GETURL_URL = GETINFO_URL + "/download-url"
 
 def resolve_project_id(proj_id):
     headers = {"User-Agent": "curl"}
-    resp = requests.get(f"{ADDON_URL}/{proj_id}", headers=headers)
+    resp = mirror.get(f"{ADDON_URL}/{proj_id}", headers=headers)
     resp.raise_for_status()
     meta = resp.json()
     files = meta["latestFiles"]
@@ -39,7 +39,7 @@ def get_file_url(file_id, proj_id=None):
     headers = {"User-Agent": "curl"}
     if proj_id is None:
         proj_id = "anything"
-    resp = requests.get(GETURL_URL.format(proj_id, file_id), headers=headers)
+    resp = mirror.get(GETURL_URL.format(proj_id, file_id), headers=headers)
     resp.raise_for_status()
     return resp.text
 
@@ -62,6 +62,14 @@ def resolve_packurl(path):
             raise ValueError("Unsupported URL")
 
 
+def get_file_sha1(file_info):
+    # Algorithm 1 is sha1, 2 is md5.
+    for h in file_info.get("hashes", []):
+        if h.get("algo") == 1:
+            return h["value"]
+    return None
+
+
 def resolve_ccip(filename):
     xml = ElementTree.parse(filename)
     proj_attr = xml.find("project").attrib
@@ -124,7 +132,7 @@ def install_from_zip(zipfileobj, launcher, instance_manager, instance_name=None)
 
         project_files = {mod["projectID"]: mod["fileID"] for mod in manifest["files"]}
         headers = {"User-Agent": "curl"}
-        dq = DownloadQueue()
+        dq = DownloadQueue(launcher)
 
         logger.info("Retrieving mod metadata from curse")
         modcount = len(project_files)
@@ -137,7 +145,7 @@ def install_from_zip(zipfileobj, launcher, instance_manager, instance_name=None)
             # we are looking for. It's a gamble, but usually worth it in terms
             # of request count. The time benefit is not that great, as the endpoint
             # is slow.
-            resp = requests.post(
+            resp = mirror.post(
                 ADDON_URL, json=list(project_files.keys()), headers=headers
             )
             resp.raise_for_status()
@@ -151,6 +159,7 @@ def install_from_zip(zipfileobj, launcher, instance_manager, instance_name=None)
                             file_info["downloadUrl"],
                             moddir / file_info["fileName"],
                             size=file_info["fileLength"],
+                            sha1=get_file_sha1(file_info),
                         )
                         del project_files[proj_id]
 
@@ -161,7 +170,7 @@ def install_from_zip(zipfileobj, launcher, instance_manager, instance_name=None)
             with ThreadPoolExecutor(max_workers=16) as tpe:
 
                 def dl(pid, fid):
-                    resp = requests.get(GETINFO_URL.format(pid, fid), headers=headers)
+                    resp = mirror.get(GETINFO_URL.format(pid, fid), headers=headers)
                     resp.raise_for_status()
                     file_info = resp.json()
                     assert file_info["id"] == fid
@@ -169,6 +178,7 @@ def install_from_zip(zipfileobj, launcher, instance_manager, instance_name=None)
                         file_info["downloadUrl"],
                         moddir / file_info["fileName"],
                         size=file_info["fileLength"],
+                        sha1=get_file_sha1(file_info),
                     )
 
                 # Get remaining individually
@@ -222,7 +232,7 @@ def install_from_path(path, launcher, instance_manager, instance_name=None):
             die("File must be .ccip or .zip")
 
     zipurl = resolve_packurl(path)
-    with requests.get(zipurl, stream=True) as r:
+    with mirror.get(zipurl, stream=True) as r:
         r.raise_for_status()
         with TemporaryFile() as tempfile:
             for chunk in r.iter_content(chunk_size=8192):
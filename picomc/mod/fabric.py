@@ -3,8 +3,8 @@ import urllib.parse
 from datetime import datetime, timezone
 
 import click
-import requests
 
+from picomc import mirror
 from picomc.cli.utils import pass_launcher
 from picomc.logging import logger
 from picomc.utils import Directory, die
@@ -25,7 +25,7 @@ class VersionError(Exception):
 
 def latest_game_version():
     url = "https://meta.fabricmc.net/v2/versions/game"
-    obj = requests.get(url).json()
+    obj = mirror.get(url).json()
     for ver in obj:
         if ver["stable"]:
             return ver["version"]
@@ -35,7 +35,7 @@ def get_loader_meta(game_version, loader_version):
     url = "https://meta.fabricmc.net/v2/versions/loader/{}".format(
         urllib.parse.quote(game_version)
     )
-    obj = requests.get(url).json()
+    obj = mirror.get(url).json()
     if len(obj) == 0:
         raise VersionError("Specified game version is unsupported")
     if loader_version is None:
@@ -11,8 +11,8 @@ from xml.etree import ElementTree
 from zipfile import ZipFile
 
 import click
-import requests
 
+from picomc import mirror
 from picomc.cli.utils import pass_launcher
 from picomc.downloader import DownloadQueue
 from picomc.library import Artifact
@@ -71,7 +71,7 @@ class InstallationError(Exception):
 
 
 def get_all_versions():
-    resp = requests.get(urllib.parse.urljoin(MAVEN_URL, META_FILE))
+    resp = mirror.get(urllib.parse.urljoin(MAVEN_URL, META_FILE))
     X = ElementTree.fromstring(resp.content)
     return (v.text for v in X.findall("./versioning/versions/"))
 
@@ -81,7 +81,7 @@ def _version_as_tuple(ver):
 
 
 def get_applicable_promos(latest=False):
-    resp = requests.get(urllib.parse.urljoin(MAVEN_URL, PROMO_FILE))
+    resp = mirror.get(urllib.parse.urljoin(MAVEN_URL, PROMO_FILE))
     promo_obj = resp.json()
 
     for id_, forge_version in promo_obj["promos"].items():
@@ -152,7 +152,8 @@ class ForgeInstallContext:
 
 
 def install_classic(ctx: ForgeInstallContext):
-    # TODO Some processing of the libraries should be done to remove duplicates.
+    # Duplicates of the vanilla libraries are dropped when the libraries of
+    # the version are resolved.
     vspec = make_base_vspec(ctx)
     save_vspec(ctx, vspec)
     install_meta = ctx.install_profile["install"]
@@ -182,9 +183,8 @@ def make_base_vspec(ctx: ForgeInstallContext):
         vspec["jar"] = vi["inheritsFrom"]  # Prevent vanilla jar duplication
     else:
         # This is the case for som really old forge versions, before the
-        # launcher supported inheritsFrom. Libraries should also be filtered
-        # in this case, as they contain everything from the vanilla vspec as well.
-        # TODO
+        # launcher supported inheritsFrom. The libraries contain everything
+        # from the vanilla vspec as well, which is dropped as duplicates.
         logger.warning(
             "Support for this version of Forge is not epic yet. Problems may arise."
         )
@@ -2,8 +2,8 @@ from operator import itemgetter
 from pathlib import Path, PurePath
 
 import click
-import requests
 
+from picomc import mirror
 from picomc.cli.utils import pass_instance_manager, pass_launcher
 from picomc.downloader import DownloadQueue
 from picomc.logging import logger
@@ -28,7 +28,7 @@ class APIError(FTBError):
 
 
 def get_pack_manifest(pack_id):
-    resp = requests.get(MODPACK_URL.format(pack_id))
+    resp = mirror.get(MODPACK_URL.format(pack_id))
     resp.raise_for_status()
     j = resp.json()
     if j["status"] == "error":
@@ -37,7 +37,7 @@ def get_pack_manifest(pack_id):
 
 
 def get_version_manifest(pack_id, version_id):
-    resp = requests.get(VERSION_URL.format(pack_id, version_id))
+    resp = mirror.get(VERSION_URL.format(pack_id, version_id))
     resp.raise_for_status()
     j = resp.json()
     if j["status"] == "error":
@@ -115,11 +115,12 @@ def install(pack_id, version, launcher, im, instance_name, use_beta):
     inst.config["java.memory.max"] = str(version_manifest["specs"]["recommended"]) + "M"
 
     mcdir: Path = inst.get_minecraft_dir()
-    dq = DownloadQueue()
+    dq = DownloadQueue(launcher)
     for f in version_manifest["files"]:
         filepath: Path = mcdir / PurePath(f["path"]) / f["name"]
         filepath.parent.mkdir(exist_ok=True, parents=True)
-        dq.add(f["url"], filepath, f["size"])
+        # Configs and scripts of the pack get edited in the game directory.
+        dq.add(f["url"], filepath, f["size"], sha1=f.get("sha1", None), hardlink=False)
 
     logger.info("Downloading modpack files")
     dq.download()
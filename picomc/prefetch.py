@@ -0,0 +1,123 @@
+import dataclasses
+import os
+import platform
+import time
+from xml.etree.ElementTree import ParseError
+
+from picomc.downloader import parse_rate, parse_workers
+from picomc.java import get_java_info
+from picomc.logging import logger
+
+# Instances are not a version, they stand for the versions of all instances.
+INSTANCES = "instances"
+NICENESS = 10
+
+
+def parse_version_list(value):
+    """Parses the list of versions to prefetch. Values set from the command
+    line are strings, separated by commas or whitespace."""
+    if isinstance(value, str):
+        return value.replace(",", " ").split()
+    return list(value)
+
+
+class Prefetcher:
+    """Downloads the files of the versions which are likely to be played next,
+    so that launching them does not wait on the network. The manifest is
+    checked for new versions on an interval, and everything is downloaded
+    with the prefetch rate limit and number of workers."""
+
+    def __init__(self, launcher):
+        self.launcher = launcher
+        self.vm = launcher.version_manager
+        self.config = launcher.global_config
+        self.java_infos = dict()
+
+    def apply_settings(self):
+        settings = {
+            "rate_limit": parse_rate(self.config["prefetch.rate_limit"]),
+            "workers": parse_workers(self.config["prefetch.workers"]),
+        }
+        # The global --limit-rate and --workers still win.
+        for name in self.launcher.download_overrides:
+            settings.pop(name, None)
+        self.launcher.download_settings = dataclasses.replace(
+            self.launcher.download_settings, **settings
+        )
+
+    def get_java_info(self, java):
+        if java not in self.java_infos:
+            try:
+                self.java_infos[java] = get_java_info(java)
+            except (OSError, ParseError) as ex:
+                # Only the rules of the libraries need it, and those only
+                # depend on the os version.
+                logger.debug("Failed to get java info of {}: {}".format(java, ex))
+                self.java_infos[java] = {"os.version": platform.release()}
+        return self.java_infos[java]
+
+    def get_targets(self):
+        """Returns the versions to prefetch, by name, along with the java used
+        to run them."""
+        targets = dict()
+        java = self.config["java.path"]
+        for name in parse_version_list(self.config["prefetch.versions"]):
+            if name != INSTANCES:
+                targets.setdefault(self.vm.resolve_version_name(name), java)
+                continue
+            im = self.launcher.instance_manager
+            for iname in im.list():
+                iconfig = im.get(iname).config
+                version = self.vm.resolve_version_name(iconfig["version"])
+                targets.setdefault(version, iconfig["java.path"])
+        return targets
+
+    def prefetch(self, name, java):
+        # Versions which are complete only cost a check of their files.
+        logger.info("Prefetching {}".format(name))
+        version = self.vm.get_version(name, verify=True)
+        q = version.prepare(self.get_java_info(java))
+        if q.failures:
+            logger.warning(
+                "Failed to prefetch {} files of {}".format(len(q.failures), name)
+            )
+            return False
+        return True
+
+    def run_once(self):
+        """Prefetches all versions once. Returns whether they were all
+        downloaded."""
+        self.vm.refresh_manifest()
+        ok = True
+        for name, java in self.get_targets().items():
+            try:
+                ok = self.prefetch(name, java) and ok
+            except (Exception, SystemExit) as ex:
+                # die() was already logged, others are not fatal to a long
+                # running prefetch either.
+                if not isinstance(ex, SystemExit):
+                    logger.error("Failed to prefetch {}: {}".format(name, ex))
+                ok = False
+        # Otherwise they are only saved when the prefetch is stopped.
+        self.launcher.hash_cache.save_if_dirty()
+        self.launcher.asset_inventory.save()
+        return ok
+
+    def run(self, interval=None):
+        """Prefetches all versions every `interval` seconds, or just once if
+        `interval` is None."""
+        self.apply_settings()
+        if hasattr(os, "nice"):
+            os.nice(NICENESS)
+        if interval is None:
+            return self.run_once()
+        try:
+            while True:
+                try:
+                    self.run_once()
+                except RuntimeError as ex:
+                    logger.error("Prefetch failed: {}".format(ex))
+                logger.debug("Next prefetch in {:.0f}s".format(interval))
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            return True
@@ -1,45 +1,75 @@
 import re
+from dataclasses import dataclass
+from typing import FrozenSet, Optional
 
 from picomc.logging import logger
 from picomc.osinfo import osinfo
 
+KNOWN_RULE_KEYS = frozenset(["action", "os", "features"])
 
-def match_rule(rule, java_info):
-    # This launcher currently does not support any of the extended
-    # features, which currently include at least:
-    #   - is_demo_user
-    #   - has_custom_resolution
-    # It is not clear whether an `os` and `features` matcher may
-    # be present simultaneously - assuming not.
-    if "features" in rule:
-        return False
 
-    if "os" in rule:
-        os_version = osinfo.get_os_version(java_info)
+@dataclass(frozen=True)
+class RuleEnv:
+    """What rules are matched against, gathered once instead of for every
+    rule."""
+
+    platform: str
+    arch: str
+    os_version: Optional[str]
+    # Names of the enabled features, like is_demo_user and
+    # has_custom_resolution
+    features: FrozenSet[str] = frozenset()
+
+    @classmethod
+    def create(cls, java_info, features=()):
+        return cls(
+            platform=osinfo.platform,
+            arch=osinfo.arch,
+            os_version=osinfo.get_os_version(java_info),
+            features=frozenset(features),
+        )
+
 
-        osmatch = True
-        if "name" in rule["os"]:
-            osmatch = osmatch and rule["os"]["name"] == osinfo.platform
-        if "arch" in rule["os"]:
-            osmatch = osmatch and re.match(rule["os"]["arch"], osinfo.arch)
-        if "version" in rule["os"]:
-            osmatch = osmatch and re.match(rule["os"]["version"], os_version)
-        return osmatch
+# Compiled patterns of the os matchers. The pattern cache of the re module
+# would do, but a lookup in it costs about as much as the match itself.
+_patterns = dict()
 
-    if len(rule) > 1:
+
+def match_pattern(pattern, value):
+    regex = _patterns.get(pattern)
+    if regex is None:
+        regex = _patterns[pattern] = re.compile(pattern)
+    return value is not None and regex.match(value) is not None
+
+
+def match_rule(rule, env):
+    osrule = rule.get("os")
+    if osrule is not None:
+        if "name" in osrule and osrule["name"] != env.platform:
+            return False
+        if "arch" in osrule and not match_pattern(osrule["arch"], env.arch):
+            return False
+        if "version" in osrule and not match_pattern(osrule["version"], env.os_version):
+            return False
+    # Both an os and a features matcher have to match, if both are present.
+    features = rule.get("features")
+    if features is not None:
+        for feature, value in features.items():
+            if (feature in env.features) != bool(value):
+                return False
+    if not KNOWN_RULE_KEYS.issuperset(rule):
         logger.warning("Not matching unknown rule {}".format(rule.keys()))
         return False
-
     return True
 
 
-def match_ruleset(ruleset, java_info):
+def match_ruleset(ruleset, env):
     # An empty ruleset is satisfied, but if a ruleset only contains rules which
     # you don't match, it is not.
     if len(ruleset) == 0:
         return True
     sat = False
     for rule in ruleset:
-        if match_rule(rule, java_info):
+        if match_rule(rule, env):
             sat = rule["action"] == "allow"
     return sat
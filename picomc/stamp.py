@@ -0,0 +1,47 @@
+import json
+import os
+
+from picomc.hashcache import stat_key
+from picomc.logging import logger
+
+
+class PrepareStamp:
+    """Records the inputs of a successful prepare, together with the state of
+    the files it provided. A launch with the same inputs, whose files were not
+    touched since, does not need to prepare again."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def is_current(self, digest):
+        try:
+            with open(self.path) as fd:
+                stamp = json.load(fd)
+        except (OSError, ValueError):
+            return False
+        if stamp.get("digest") != digest:
+            return False
+        for path, key in stamp.get("files", dict()).items():
+            try:
+                if stat_key(os.stat(path)) != key:
+                    logger.debug("Prepare stamp is stale, {} changed".format(path))
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def save(self, digest, paths):
+        try:
+            files = {str(path): stat_key(os.stat(path)) for path in paths}
+        except OSError:
+            # Some files are missing, so the next launch has to prepare again.
+            self.clear()
+            return
+        with open(self.path, "w") as fd:
+            json.dump({"digest": digest, "files": files}, fd)
+
+    def clear(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,57 @@
+import os
+from pathlib import Path
+
+from picomc.logging import logger
+from picomc.utils import link_file
+
+
+class BlobStore:
+    """A content-addressed store of files keyed by their sha1 hash, laid out
+    the same way as the asset objects. Files in the launcher tree (libraries,
+    client jars, mod jars, ...) are linked to the blobs instead of holding
+    their own copy of the data. Files in the tree are usually hardlinks to
+    their blob, so damaging one damages the blob as well. With a `hash_cache`,
+    blobs are checked before they are used and evicted if they are bad."""
+
+    def __init__(self, root, hash_cache=None):
+        self.root = Path(root)
+        self.hash_cache = hash_cache
+
+    def get_path(self, sha1):
+        return self.root / sha1[0:2] / sha1
+
+    def has(self, sha1):
+        return self.get_path(sha1).is_file()
+
+    def is_intact(self, blob, sha1):
+        return self.hash_cache is None or self.hash_cache.check(blob, sha1)
+
+    def link_to(self, sha1, dest, hardlink=True):
+        """Materializes the blob at `dest`. Returns False if the blob is not
+        present in the store, or was evicted because it does not match its
+        hash. Files which may be modified in place must not be hardlinks to the
+        blob, as that would modify the blob too."""
+        blob = self.get_path(sha1)
+        if not blob.is_file():
+            return False
+        if not self.is_intact(blob, sha1):
+            logger.warning("Evicting damaged blob {} from store".format(sha1))
+            try:
+                os.unlink(blob)
+            except FileNotFoundError:
+                pass
+            return False
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        method = link_file(blob, dest, hardlink=hardlink)
+        logger.debug("Linked {} from store ({})".format(dest, method))
+        return True
+
+    def adopt(self, path, sha1, hardlink=True):
+        """Adds an existing file into the store. The caller is responsible for
+        making sure that its contents actually match the hash. A blob which is
+        already present is replaced if it does not match."""
+        blob = self.get_path(sha1)
+        if blob.is_file() and self.is_intact(blob, sha1):
+            return
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        link_file(path, blob, hardlink=hardlink)
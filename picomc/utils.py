@@ -1,13 +1,25 @@
 import hashlib
 import os
 import re
+import secrets
+import shutil
 import sys
+import tempfile
+from contextlib import contextmanager
 from enum import Enum, auto
 from functools import partial
 from pathlib import Path
 
 from picomc.logging import logger
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
 
 def join_classpath(*cp):
     return os.pathsep.join(map(str, cp))
@@ -21,6 +33,61 @@ def file_sha1(filename):
     return h.hexdigest()
 
 
+def _reflink(src, dst):
+    if fcntl is None:
+        raise OSError("Reflinks are not supported on this platform")
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def link_file(src, dst, hardlink=True):
+    """Makes `dst` a hardlink to `src`. If that is not possible, a reflink is
+    attempted and a plain copy is the last resort. An existing `dst` is replaced
+    atomically. Returns the name of the method which succeeded. Without
+    `hardlink`, `dst` gets its own inode, for files which may be modified."""
+    if hardlink:
+        try:
+            if os.path.samefile(src, dst):
+                return "hardlink"
+        except FileNotFoundError:
+            pass
+    tmp = "{}.{}.tmp".format(dst, secrets.token_hex(4))
+    try:
+        try:
+            if not hardlink:
+                raise OSError("Hardlinks are not wanted")
+            os.link(src, tmp)
+            method = "hardlink"
+        except OSError:
+            try:
+                _reflink(src, tmp)
+                method = "reflink"
+            except OSError:
+                shutil.copyfile(src, tmp)
+                method = "copy"
+        os.replace(tmp, dst)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+    return method
+
+
+@contextmanager
+def atomic_write(path, mode="w"):
+    """Opens a temporary file next to `path`, which replaces `path` once the
+    block completes. Each writer gets a temporary file of its own, so that
+    concurrent writers of the same file do not clobber each other."""
+    path = Path(path)
+    fd, tmp = tempfile.mkstemp(prefix=".{}.".format(path.name), dir=path.parent)
+    try:
+        with os.fdopen(fd, mode) as fp:
+            yield fp
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+
 def die(mesg, code=1):
     logger.error(mesg)
     sys.exit(code)
@@ -43,8 +110,13 @@ class Directory(Enum):
     ASSET_INDEXES = auto()
     ASSET_OBJECTS = auto()
     ASSET_VIRTUAL = auto()
+    CACHE = auto()
+    CDS_CACHE = auto()
     INSTANCES = auto()
     LIBRARIES = auto()
+    LIBRARY_CACHE = auto()
+    NATIVES = auto()
+    STORE = auto()
     VERSIONS = auto()
 
 
@@ -0,0 +1,43 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from tqdm import tqdm
+
+import picomc.logging
+
+BATCH_SIZE = 32
+
+
+def get_default_workers():
+    # Reading and hashing both release the GIL, so threads scale with the
+    # cores, and a few more keep the disk busy while others hash.
+    return min(32, (os.cpu_count() or 1) * 2)
+
+
+def check_batch(hash_cache, batch):
+    return [hash_cache.check(entry[0], entry[1]) for entry in batch]
+
+
+def verify_files(hash_cache, files, workers=None):
+    """Checks the hashes of `files`, a list of tuples starting with the path
+    and the expected sha1, on a thread pool. Yields each tuple together with
+    whether the file is intact, as the results come in."""
+    if not files:
+        return
+    workers = workers or get_default_workers()
+    # Small batches keep the overhead per file low, while leaving enough of
+    # them to balance the load between the threads.
+    size = max(1, min(BATCH_SIZE, len(files) // (workers * 4)))
+    batches = [files[i : i + size] for i in range(0, len(files), size)]
+    with tqdm(
+        total=len(files), unit="file", disable=picomc.logging.debug
+    ) as tq, ThreadPoolExecutor(max_workers=workers) as tpe:
+        futures = {tpe.submit(check_batch, hash_cache, b): b for b in batches}
+        try:
+            for fut in as_completed(futures):
+                batch = futures[fut]
+                tq.update(len(batch))
+                yield from zip(batch, fut.result())
+        finally:
+            for fut in futures:
+                fut.cancel()
@@ -1,22 +1,31 @@
 import enum
+import hashlib
 import json
 import operator
 import os
 import posixpath
-import shutil
+import tempfile
+import time
 import urllib.parse
 import urllib.request
+from collections import Counter
 from functools import reduce
 from pathlib import PurePath
 
 import requests
 
-from picomc.downloader import DownloadQueue
+from picomc import mirror
+from picomc.assetindex import AssetIndex
+from picomc.downloader import DownloadQueue, Priority
+from picomc.hashcache import stat_key
+from picomc.httpcache import CachedFile
 from picomc.java import get_java_info
-from picomc.library import Library
+from picomc.library import Library, get_arch_bits, merge_libraries
 from picomc.logging import logger
-from picomc.rules import match_ruleset
-from picomc.utils import Directory, die, file_sha1, recur_files
+from picomc.osinfo import osinfo
+from picomc.rules import RuleEnv, match_ruleset
+from picomc.utils import Directory, cached_property, die, link_file
+from picomc.verify import verify_files
 
 
 class VersionType(enum.Flag):
@@ -70,6 +79,13 @@ LEGACY_ASSETS = {
     ),
 }
 
+# Invalidates the existing prepare stamps when what they cover changes
+PREPARE_STAMP_VERSION = 1
+# Invalidates the library cache when the way libraries are resolved changes
+LIBRARY_CACHE_VERSION = 2
+# Seconds after which unused entries of the library cache are removed
+LIBRARY_CACHE_MAX_AGE = 30 * 86400
+
 LEGACY_JAVA_VERSION = {
     "component": "jre-legacy",
     "majorVersion": 8,
@@ -87,7 +103,9 @@ class VersionSpec:
         chain.append(self.vobj)
         cv = self.vobj
         while "inheritsFrom" in cv.raw_vspec:
-            cv = version_manager.get_version(cv.raw_vspec["inheritsFrom"])
+            cv = version_manager.get_version(
+                cv.raw_vspec["inheritsFrom"], verify=self.vobj.verify
+            )
             chain.append(cv)
         return chain
 
@@ -133,8 +151,10 @@ class VersionSpec:
 class Version:
     ASSETS_URL = "https://resources.download.minecraft.net/"
 
-    def __init__(self, version_name, launcher, version_manifest):
+    def __init__(self, version_name, launcher, version_manifest, verify=False):
         self.version_name = version_name
+        # Whether the vspecs of the chain were checked against the manifest
+        self.verify = verify
         self.launcher = launcher
         self.vm = launcher.version_manager
         self.version_manifest = version_manifest
@@ -146,29 +166,42 @@ class Version:
         self.raw_vspec = self.get_raw_vspec()
         self.vspec = VersionSpec(self, self.vm)
 
-        if self.vspec.assetIndex is not None:
-            self.raw_asset_index = self.get_raw_asset_index(self.vspec.assetIndex)
-
         self.jarname = self.vspec.jar
         self.jarfile = self.versions_root / self.jarname / "{}.jar".format(self.jarname)
 
         self.java_version = self.vspec.javaVersion
 
+    @cached_property
+    def asset_index(self):
+        # Loaded on demand, parents in an inheritance chain never need it.
+        if self.vspec.assetIndex is None:
+            return None
+        return self.get_asset_index(self.vspec.assetIndex)
+
     def get_raw_vspec(self):
-        vspec_path = (
-            self.versions_root / self.version_name / "{}.json".format(self.version_name)
-        )
+        vspec_path = self.vm.get_local_vspec_path(self.version_name)
         if not self.version_manifest:
-            if vspec_path.exists():
-                logger.debug("Found custom vspec ({})".format(self.version_name))
+            if not vspec_path.exists():
+                die("Specified version ({}) not available".format(self.version_name))
+            logger.debug("Using local vspec ({})".format(self.version_name))
+            try:
                 with open(vspec_path) as fp:
                     return json.load(fp)
-            else:
+            except ValueError as ex:
+                logger.warning(
+                    "Local vspec of {} is corrupt: {}".format(self.version_name, ex)
+                )
+            # Downloaded again, if it is in the manifest.
+            try:
+                self.version_manifest = self.vm.manifest_index.get(self.version_name)
+            except RuntimeError:
+                pass
+            if not self.version_manifest:
                 die("Specified version ({}) not available".format(self.version_name))
         url = self.version_manifest["url"]
         sha1 = self.version_manifest["sha1"]
 
-        if vspec_path.exists() and file_sha1(vspec_path) == sha1:
+        if self.launcher.hash_cache.check(vspec_path, sha1):
             logger.debug(
                 "Using cached vspec files, hash matches manifest ({})".format(
                     self.version_name
@@ -179,11 +212,12 @@ class Version:
 
         try:
             logger.debug("Downloading vspec file")
-            raw = requests.get(url).content
+            raw = mirror.get(url).content
+            # Parsed before writing, so that a broken download is not stored.
+            j = json.loads(raw)
             vspec_path.parent.mkdir(parents=True, exist_ok=True)
             with open(vspec_path, "wb") as fp:
                 fp.write(raw)
-            j = json.loads(raw)
             return j
         except requests.ConnectionError:
             die("Failed to retrieve version json file. Check your internet connection.")
@@ -193,26 +227,116 @@ class Version:
         url = asset_index_spec["url"]
         sha1 = asset_index_spec["sha1"]
         fpath = self.launcher.get_path(Directory.ASSET_INDEXES, "{}.json".format(iid))
-        if fpath.exists() and file_sha1(fpath) == sha1:
+        if self.launcher.hash_cache.check(fpath, sha1):
             logger.debug("Using cached asset index, hash matches vspec")
-            with open(fpath) as fp:
-                return json.load(fp)
+            with open(fpath, "rb") as fp:
+                return fp.read()
         try:
             logger.debug("Downloading new asset index")
-            raw = requests.get(url).content
-            with open(fpath, "wb") as fp:
-                fp.write(raw)
-            return json.loads(raw)
+            raw = mirror.get(url).content
         except requests.ConnectionError:
             die("Failed to retrieve asset index.")
+        if hashlib.sha1(raw).hexdigest() != sha1:
+            die("Downloaded asset index does not match the vspec.")
+        with open(fpath, "wb") as fp:
+            fp.write(raw)
+        self.launcher.hash_cache.record(fpath, sha1)
+        return raw
+
+    def get_compiled_asset_index(self, iid, sha1, get_raw):
+        """Returns the compiled asset index with the given id, compiling it
+        from the json returned by `get_raw` if it is out of date."""
+        path = self.launcher.get_path(Directory.ASSET_INDEXES, "{}.idx".format(iid))
+        index = AssetIndex.open(path, sha1)
+        if index is None:
+            logger.debug("Compiling asset index {}".format(iid))
+            AssetIndex.compile(get_raw(), sha1, path)
+            index = AssetIndex(path)
+        return index
+
+    def get_asset_index(self, asset_index_spec):
+        return self.get_compiled_asset_index(
+            asset_index_spec["id"],
+            asset_index_spec["sha1"],
+            lambda: self.get_raw_asset_index(asset_index_spec),
+        )
 
-    def get_raw_asset_index_nodl(self, id_):
+    def get_asset_index_nodl(self, id_):
+        spec = self.vspec.assetIndex
+        if spec is not None and spec["id"] == id_:
+            return self.asset_index
         fpath = self.launcher.get_path(Directory.ASSET_INDEXES, "{}.json".format(id_))
-        if fpath.exists():
-            with open(fpath) as fp:
-                return json.load(fp)
-        else:
+        if not fpath.exists():
             die("Asset index specified in 'assets' not available.")
+        return self.get_compiled_asset_index(
+            id_, self.launcher.hash_cache.sha1(fpath), fpath.read_bytes
+        )
+
+    def get_vspec_hashes(self):
+        """Returns the sha1 hashes of the vspecs in the inheritance chain."""
+        return [
+            self.launcher.hash_cache.sha1(self.vm.get_local_vspec_path(v.version_name))
+            for v in self.vspec.chain
+        ]
+
+    def get_library_cache_path(self, java_info):
+        """Returns the path of the resolved libraries in the library cache.
+        They depend on the vspecs and everything the rules and natives
+        classifiers are evaluated against."""
+        env = RuleEnv.create(java_info)
+        inputs = [
+            LIBRARY_CACHE_VERSION,
+            self.get_vspec_hashes(),
+            java_info.get("java.home") if java_info else None,
+            [env.platform, env.arch, env.os_version, get_arch_bits()],
+        ]
+        key = hashlib.sha1(json.dumps(inputs).encode()).hexdigest()
+        return self.launcher.get_path(Directory.LIBRARY_CACHE, "{}.json".format(key))
+
+    def resolve_libraries(self, java_info):
+        libs = []
+        env = RuleEnv.create(java_info)
+        for lib in self.vspec.libraries:
+            if "rules" in lib and not match_ruleset(lib["rules"], env):
+                continue
+            lib_obj = Library(lib)
+            if not lib_obj.available:
+                continue
+            libs.append(lib_obj)
+        # Modded vspecs often carry other versions of the libraries they
+        # inherit, or all of them again.
+        return merge_libraries(libs)
+
+    def load_libraries(self, java_info):
+        """Returns the libraries from the library cache, resolving and storing
+        them if they are not there yet."""
+        try:
+            path = self.get_library_cache_path(java_info)
+        except FileNotFoundError:
+            # The vspec is not stored locally, so it can not be keyed.
+            return self.resolve_libraries(java_info)
+        try:
+            with open(path) as fd:
+                libs = [Library.from_dict(d) for d in json.load(fd)["libraries"]]
+            # Keeps it from being pruned.
+            os.utime(path)
+            return libs
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as ex:
+            logger.debug("Discarding cached libraries {}: {}".format(path, ex))
+        libs = self.resolve_libraries(java_info)
+        # Concurrent launches may be storing the same entry.
+        fd, tmp = tempfile.mkstemp(prefix=".{}.".format(path.name), dir=path.parent)
+        try:
+            with os.fdopen(fd, "w") as fp:
+                json.dump({"libraries": [lib.to_dict() for lib in libs]}, fp)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+        self.vm.prune_library_cache()
+        return libs
 
     def get_libraries(self, java_info):
         if java_info is not None:
@@ -222,21 +346,14 @@ class Version:
         if key and key in self._libraries:
             return self._libraries[key]
         else:
-            libs = []
-            for lib in self.vspec.libraries:
-                if "rules" in lib and not match_ruleset(lib["rules"], java_info):
-                    continue
-                lib_obj = Library(lib)
-                if not lib_obj.available:
-                    continue
-                libs.append(lib_obj)
+            libs = self.load_libraries(java_info)
             if key:
                 self._libraries[key] = libs
             return libs
 
     def get_jarfile_dl(self, verify_hashes=False, force=False):
         """Checks existence and hash of cached jar. Returns None if ok, otherwise
-        returns download (url, size)"""
+        returns download (url, size, sha1)"""
         logger.debug("Attempting to use jarfile: {}".format(self.jarfile))
         dlspec = self.vspec.downloads.get("client", None)
         if dlspec is None:
@@ -253,53 +370,129 @@ class Version:
             # quirk of an old (git blame 2 years) version of the vanilla launcher.
             # https://github.com/FabricMC/fabric-installer/blob/master/src/main/java/net/fabricmc/installer/client/ClientInstaller.java#L49
             or os.path.getsize(self.jarfile) == 0
-            or (verify_hashes and file_sha1(self.jarfile) != dlspec["sha1"])
+            or (
+                verify_hashes
+                and not self.launcher.hash_cache.check(self.jarfile, dlspec["sha1"])
+            )
         ):
             logger.info(
                 "Jar file ({}) will be downloaded with libraries.".format(self.jarname)
             )
-            return dlspec["url"], dlspec.get("size", None)
+            return dlspec["url"], dlspec.get("size", None), dlspec.get("sha1", None)
 
-    def download_libraries(self, java_info, verify_hashes=False, force=False):
-        """Downloads missing libraries."""
+    def queue_libraries(self, q, java_info, verify_hashes=False, force=False):
+        """Adds missing libraries and the jar file to the DownloadQueue. They
+        are needed to launch the game, so they are queued as critical."""
         logger.info("Checking libraries.")
-        q = DownloadQueue()
+        basedir = self.launcher.get_path(Directory.LIBRARIES)
+        to_verify = []
         for library in self.get_libraries(java_info):
             if not library.available:
                 continue
-            basedir = self.launcher.get_path(Directory.LIBRARIES)
             abspath = library.get_abspath(basedir)
             ok = abspath.is_file() and os.path.getsize(abspath) > 0
-            if verify_hashes and library.sha1 is not None:
-                ok = ok and file_sha1(abspath) == library.sha1
-            if not ok and not library.url:
-                logger.error(
-                    f"Library {library.filename} is missing or corrupt "
-                    "and has no download url."
-                )
+            if ok and verify_hashes and not force and library.sha1 is not None:
+                to_verify.append((abspath, library.sha1, library))
                 continue
-            if force or not ok:
-                q.add(library.url, library.get_abspath(basedir), library.size)
+            self.queue_library(q, library, abspath, ok, force)
+        for (abspath, _, library), ok in verify_files(
+            self.launcher.hash_cache, to_verify
+        ):
+            self.queue_library(q, library, abspath, ok, force)
         jardl = self.get_jarfile_dl(verify_hashes, force)
         if jardl is not None:
-            url, size = jardl
-            q.add(url, self.jarfile, size=size)
-        if len(q) > 0:
-            logger.info("Downloading {} libraries.".format(len(q)))
-        if not q.download():
+            url, size, sha1 = jardl
+            q.add(url, self.jarfile, size=size, sha1=sha1, priority=Priority.CRITICAL)
+
+    def queue_library(self, q, library, abspath, ok, force=False):
+        if not ok and not library.url:
             logger.error(
-                "Some libraries failed to download. If they are part of a non-vanilla "
-                "profile, the original installer may need to be used."
+                f"Library {library.filename} is missing or corrupt "
+                "and has no download url."
+            )
+            return
+        if force or not ok:
+            q.add(
+                library.url,
+                abspath,
+                library.size,
+                sha1=library.sha1,
+                priority=Priority.CRITICAL,
             )
 
-    def _populate_virtual_assets(self, asset_index, where):
-        for name, obj in asset_index["objects"].items():
-            sha = obj["hash"]
-            objpath = self.launcher.get_path(Directory.ASSET_OBJECTS, sha[0:2], sha)
+    def report_library_failures(self):
+        logger.error(
+            "Some libraries failed to download. If they are part of a non-vanilla "
+            "profile, the original installer may need to be used."
+        )
+
+    def download_libraries(self, java_info, verify_hashes=False, force=False):
+        """Downloads missing libraries."""
+        q = DownloadQueue(self.launcher)
+        self.queue_libraries(q, java_info, verify_hashes, force)
+        if len(q) > 0:
+            logger.info("Downloading {} libraries.".format(len(q)))
+        if not q.download():
+            self.report_library_failures()
+
+    def _populate_virtual_assets(self, asset_index, where, hardlink=True):
+        """Makes the objects of `asset_index` available under their names in
+        `where`, linked from the objects directory if possible. What was
+        populated is recorded in a manifest, and entries which did not change
+        since are skipped."""
+        # Kept next to `where`, so that the game does not find it among the
+        # assets
+        manifest_path = where.with_name(".{}.populated.json".format(where.name))
+        try:
+            with open(manifest_path) as fd:
+                manifest = json.load(fd)
+        except (OSError, ValueError):
+            manifest = dict()
+        populated = dict()
+        methods = Counter()
+        dirs = set()
+        # The objects are stat'ed as well, a repaired object is a new file
+        # which the copies and links made from the old one do not follow.
+        objects = dict()
+        for name, sha, _ in asset_index.objects():
             path = where / PurePath(*name.split("/"))
-            # Maybe check file hash first? Would that be faster?
-            path.parent.mkdir(parents=True, exist_ok=True)
-            shutil.copy(objpath, path)
+            objpath = self.launcher.get_path(Directory.ASSET_OBJECTS, sha[0:2], sha)
+            if sha not in objects:
+                try:
+                    objects[sha] = stat_key(os.stat(objpath))
+                except FileNotFoundError:
+                    objects[sha] = None
+            if objects[sha] is None:
+                logger.debug(
+                    "Asset object {} is missing, skipping {}".format(sha, name)
+                )
+                continue
+            entry = manifest.get(name)
+            # Entries are the hash, and the stat of the file and of the object
+            # when it was populated.
+            if entry is not None and entry[0] == sha and entry[2:] == [objects[sha]]:
+                try:
+                    if stat_key(os.stat(path)) == entry[1]:
+                        populated[name] = entry
+                        continue
+                except FileNotFoundError:
+                    pass
+            if path.parent not in dirs:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                dirs.add(path.parent)
+            methods[link_file(objpath, path, hardlink=hardlink)] += 1
+            populated[name] = [sha, stat_key(os.stat(path)), objects[sha]]
+        logger.debug(
+            "Populated {} assets ({}), {} were up to date".format(
+                sum(methods.values()),
+                ", ".join("{} {}".format(n, m) for m, n in methods.items()) or "-",
+                len(populated) - sum(methods.values()),
+            )
+        )
+        if populated != manifest:
+            where.mkdir(parents=True, exist_ok=True)
+            with open(manifest_path, "w") as fd:
+                json.dump(populated, fd, separators=(",", ":"))
 
     def get_virtual_asset_path(self):
         return self.launcher.get_path(
@@ -307,60 +500,159 @@ class Version:
         )
 
     def prepare_assets_launch(self, gamedir):
-        launch_asset_index = self.get_raw_asset_index_nodl(self.vspec.assets)
-        is_map_resources = launch_asset_index.get("map_to_resources", False)
-        if is_map_resources:
+        launch_asset_index = self.get_asset_index_nodl(self.vspec.assets)
+        if launch_asset_index.map_to_resources:
             logger.info("Mapping resources")
             where = gamedir / "resources"
             logger.debug("Resources path: {}".format(where))
-            self._populate_virtual_assets(launch_asset_index, where)
-
-    def download_assets(self, verify_hashes=False, force=False):
-        """Downloads missing assets."""
-
-        hashes = dict()
-        for obj in self.raw_asset_index["objects"].values():
-            hashes[obj["hash"]] = obj["size"]
-
-        logger.info("Checking {} assets.".format(len(hashes)))
-
-        is_virtual = self.raw_asset_index.get("virtual", False)
-
-        fileset = set(recur_files(self.assets_root))
-        q = DownloadQueue()
+            # The game may write to its resources, which must not reach the
+            # objects through a shared inode.
+            self._populate_virtual_assets(launch_asset_index, where, hardlink=False)
+
+    def queue_assets(self, q, verify_hashes=False, force=False):
+        """Adds missing assets to the DownloadQueue, as background files."""
+        index = self.asset_index
+        logger.info("Checking {} assets.".format(index.distinct))
+
+        inventory = self.launcher.asset_inventory
+        if verify_hashes:
+            inventory.reconcile()
         objpath = self.launcher.get_path(Directory.ASSET_OBJECTS)
-        for sha in hashes:
+        to_verify = []
+        for sha, size in index.hashes():
             abspath = objpath / sha[0:2] / sha
-            ok = abspath in fileset  # file exists
-            if verify_hashes:
-                ok = ok and file_sha1(abspath) == sha
-            if force or not ok:
-                url = urllib.parse.urljoin(
-                    self.ASSETS_URL, posixpath.join(sha[0:2], sha)
-                )
-                q.add(url, abspath, size=hashes[sha])
+            ok = sha in inventory
+            if ok and verify_hashes and not force:
+                to_verify.append((abspath, sha, size))
+            elif force or not ok:
+                self.queue_asset(q, abspath, sha, size)
+        for (abspath, sha, size), ok in verify_files(
+            self.launcher.hash_cache, to_verify
+        ):
+            if not ok:
+                inventory.discard(sha)
+                self.queue_asset(q, abspath, sha, size)
 
-        if len(q) > 0:
-            logger.info("Downloading {} assets.".format(len(q)))
-        if not q.download():
-            logger.warning("Some assets failed to download.")
+    def queue_asset(self, q, abspath, sha, size):
+        url = urllib.parse.urljoin(self.ASSETS_URL, posixpath.join(sha[0:2], sha))
+        q.add(url, abspath, size=size, sha1=sha, priority=Priority.BACKGROUND)
 
-        if is_virtual:
-            logger.info("Copying virtual assets")
+    def populate_virtual_assets(self):
+        if self.asset_index.virtual:
+            logger.info("Populating virtual assets")
             where = self.get_virtual_asset_path()
             logger.debug("Virtual asset path: {}".format(where))
-            self._populate_virtual_assets(self.raw_asset_index, where)
+            self._populate_virtual_assets(self.asset_index, where)
 
-    def prepare(self, java_info=None, verify_hashes=False):
+    def download_assets(self, verify_hashes=False, force=False):
+        """Downloads missing assets."""
+        q = DownloadQueue(self.launcher)
+        self.queue_assets(q, verify_hashes, force)
+        if len(q) > 0:
+            logger.info("Downloading {} assets.".format(len(q)))
+        if not q.download():
+            logger.warning("Some assets failed to download.")
+        self.populate_virtual_assets()
+
+    def can_launch_without_assets(self):
+        """Old versions read the assets from copies, which can only be made
+        once the assets are downloaded."""
+        index = self.asset_index
+        return not index.virtual and not index.map_to_resources
+
+    def prepare(self, java_info=None, verify_hashes=False, background_assets=False):
+        """Downloads the libraries and assets in a single queue, libraries
+        first. With `background_assets`, returns as soon as the libraries are
+        done, and the assets keep downloading. Returns the DownloadQueue, use
+        its wait method to wait for the background downloads."""
         if not java_info:
             java_info = get_java_info(self.launcher.global_config.get("java.path"))
-        self.download_libraries(java_info, verify_hashes)
-        if hasattr(self, "raw_asset_index"):
-            self.download_assets(verify_hashes)
-
-    def prepare_launch(self, gamedir, java_info, verify_hahes=False):
-        self.prepare(java_info, verify_hahes)
+        has_assets = self.asset_index is not None
+        q = DownloadQueue(self.launcher)
+        self.queue_libraries(q, java_info, verify_hashes)
+        if has_assets:
+            self.queue_assets(q, verify_hashes)
+        n_libraries = q.count(Priority.CRITICAL)
+        n_assets = q.count(Priority.BACKGROUND)
+        if n_libraries:
+            logger.info("Downloading {} libraries.".format(n_libraries))
+
+        if background_assets and n_assets and self.can_launch_without_assets():
+            logger.info("Downloading {} assets in the background.".format(n_assets))
+            q.start()
+            if not q.wait(Priority.CRITICAL):
+                self.report_library_failures()
+            return q
+
+        if n_assets:
+            logger.info("Downloading {} assets.".format(n_assets))
+        q.download()
+        failed = {failure.priority for failure in q.failures}
+        if Priority.CRITICAL in failed:
+            self.report_library_failures()
+        if Priority.BACKGROUND in failed:
+            logger.warning("Some assets failed to download.")
+        if has_assets:
+            self.populate_virtual_assets()
+        return q
+
+    def prepare_launch(
+        self, gamedir, java_info, verify_hahes=False, background_assets=False
+    ):
+        pending = self.prepare(java_info, verify_hahes, background_assets)
         self.prepare_assets_launch(gamedir)
+        return pending
+
+    def get_prepare_inputs(self, java_info, gamedir):
+        """Returns a digest of everything prepare_launch depends on, and the
+        files it provides, for a PrepareStamp."""
+        libraries = self.get_libraries(java_info)
+        inputs = {
+            "stamp": PREPARE_STAMP_VERSION,
+            "vspecs": self.get_vspec_hashes(),
+            "assetIndex": self.vspec.assetIndex,
+            "assets": self.vspec.assets,
+            "java": [
+                java_info.get(key)
+                for key in ("java.home", "java.version", "os.version")
+            ],
+            "os": [osinfo.platform, osinfo.arch],
+            "libraries": [[lib.descriptor, lib.sha1] for lib in libraries],
+            "gamedir": str(gamedir),
+        }
+        digest = hashlib.sha1(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+        basedir = self.launcher.get_path(Directory.LIBRARIES)
+        files = [lib.get_abspath(basedir) for lib in libraries] + [self.jarfile]
+        if self.vspec.assetIndex is not None:
+            iid = self.vspec.assetIndex["id"]
+            files.append(
+                self.launcher.get_path(Directory.ASSET_INDEXES, "{}.idx".format(iid))
+            )
+        return digest, files
+
+
+class ManifestIndex:
+    """Lookups into the version manifest, by id, by type and in the order of
+    release, newest first."""
+
+    def __init__(self, manifest):
+        self.latest = manifest["latest"]
+        self.by_release = sorted(
+            manifest["versions"], key=lambda v: v["releaseTime"], reverse=True
+        )
+        self.by_id = {v["id"]: v for v in self.by_release}
+        self.by_type = dict()
+        for v in self.by_release:
+            self.by_type.setdefault(v["type"], []).append(v)
+
+    def get(self, version_id):
+        return self.by_id.get(version_id)
+
+    def get_versions(self, vtype=VersionType.ANY):
+        types = [t for t in self.by_type if vtype.match(t)]
+        if len(types) == 1:
+            return self.by_type[types[0]]
+        return [v for v in self.by_release if v["type"] in types]
 
 
 class VersionManager:
@@ -369,40 +661,73 @@ class VersionManager:
     def __init__(self, launcher):
         self.launcher = launcher
         self.versions_root = launcher.get_path(Directory.VERSIONS)
-        self.manifest = self.get_manifest()
+        # Versions already loaded by this process, by name
+        self.versions = dict()
+
+    @cached_property
+    def manifest(self):
+        return self.get_manifest()
+
+    @cached_property
+    def manifest_index(self):
+        return ManifestIndex(self.manifest)
+
+    def refresh_manifest(self):
+        """Revalidates the manifest now, regardless of its TTL. The versions
+        loaded before are dropped, they were checked against the old
+        manifest."""
+        self.__dict__["manifest"] = self.get_manifest(ttl=0)
+        self.__dict__.pop("manifest_index", None)
+        self.versions.clear()
+
+    def get_cached_manifest_index(self):
+        """Returns the manifest index if the manifest is loaded already, or
+        its cached copy is fresh. Otherwise returns None, it never accesses
+        the network."""
+        if "manifest" not in self.__dict__:
+            raw = self.get_manifest_file().get_fresh()
+            if raw is None:
+                return None
+            try:
+                self.__dict__["manifest"] = json.loads(raw)
+            except ValueError:
+                return None
+        return self.manifest_index
 
     def resolve_version_name(self, v):
         """Takes a metaversion and resolves to a version."""
         if v == "latest":
-            v = self.manifest["latest"]["release"]
+            v = self.manifest_index.latest["release"]
             logger.debug("Resolved latest -> {}".format(v))
         elif v == "snapshot":
-            v = self.manifest["latest"]["snapshot"]
+            v = self.manifest_index.latest["snapshot"]
             logger.debug("Resolved snapshot -> {}".format(v))
         return v
 
-    def get_manifest(self):
+    def get_manifest_file(self, ttl=None):
         manifest_filepath = self.launcher.get_path(Directory.VERSIONS, "manifest.json")
+        if ttl is None:
+            ttl = float(self.launcher.global_config["manifest.ttl"])
+        return CachedFile(
+            self.MANIFEST_URL,
+            manifest_filepath,
+            ttl=ttl,
+            timeout=self.launcher.download_settings.timeout,
+        )
+
+    def get_manifest(self, ttl=None):
         try:
-            m = requests.get(self.MANIFEST_URL).json()
-            with open(manifest_filepath, "w") as mfile:
-                json.dump(m, mfile, indent=4, sort_keys=True)
-            return m
-        except requests.ConnectionError:
+            return json.loads(self.get_manifest_file(ttl).get())
+        except requests.RequestException:
             logger.warning(
                 "Failed to retrieve version_manifest. "
                 "Check your internet connection."
             )
-            try:
-                with open(manifest_filepath) as mfile:
-                    logger.warning("Using cached version_manifest.")
-                    return json.load(mfile)
-            except FileNotFoundError:
-                logger.warning("Cached version manifest not available.")
-                raise RuntimeError("Failed to retrieve version manifest.")
+            logger.warning("Cached version manifest not available.")
+            raise RuntimeError("Failed to retrieve version manifest.")
 
     def version_list(self, vtype=VersionType.RELEASE, local=False):
-        r = [v["id"] for v in self.manifest["versions"] if vtype.match(v["type"])]
+        r = [v["id"] for v in self.manifest_index.get_versions(vtype)]
         if local:
             r += sorted(
                 "{} [local]".format(path.name)
@@ -411,11 +736,46 @@ class VersionManager:
             )
         return r
 
-    def get_version(self, version_name):
+    def prune_library_cache(self):
+        """Removes the entries of the library cache which were not used for
+        LIBRARY_CACHE_MAX_AGE, including leftovers of interrupted writes."""
+        now = time.time()
+        for entry in os.scandir(self.launcher.get_path(Directory.LIBRARY_CACHE)):
+            try:
+                if now - entry.stat().st_mtime > LIBRARY_CACHE_MAX_AGE:
+                    logger.debug(
+                        "Removing unused cached libraries {}".format(entry.path)
+                    )
+                    os.unlink(entry.path)
+            except FileNotFoundError:
+                # Pruned by another launch at the same time
+                pass
+
+    def get_local_vspec_path(self, version_name):
+        return self.versions_root / version_name / "{}.json".format(version_name)
+
+    def get_version(self, version_name, verify=False):
+        """Returns the version. With `verify`, its vspecs are checked against
+        the manifest, even if it has to be downloaded for that."""
         name = self.resolve_version_name(version_name)
-        version_manifest = None
-        for ver in self.manifest["versions"]:
-            if ver["id"] == name:
-                version_manifest = ver
-                break
-        return Version(name, self.launcher, version_manifest)
+        if name not in self.versions or (verify and not self.versions[name].verify):
+            self.versions[name] = self.load_version(name, verify)
+        return self.versions[name]
+
+    def load_version(self, name, verify=False):
+        if verify:
+            try:
+                index = self.manifest_index
+            except RuntimeError:
+                logger.warning(
+                    "Can not check the vspec of {} without the manifest.".format(name)
+                )
+                index = None
+        elif self.get_local_vspec_path(name).is_file():
+            # A version which is already present is only checked if the
+            # manifest is at hand, it is not loaded just for that.
+            index = self.get_cached_manifest_index()
+        else:
+            index = self.manifest_index
+        entry = index.get(name) if index is not None else None
+        return Version(name, self.launcher, entry, verify)
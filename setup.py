@@ -30,6 +30,7 @@ setup(
         "coloredlogs",
         "colorama",
     ],
+    extras_require={"http2": ["h2>=4,<5"]},
     python_requires=">=3.7",
     entry_points={"console_scripts": ["picomc = picomc:main"]},
     package_data={"picomc.java": ["SysDump.class"]},